@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -----------------------------------------------------------------------------
+# json_io.py — benchmark of the filter's JSON input/output
+#
+# Builds a large synthetic pandoc AST (chapters of plain paragraphs with a
+# TikZ figure per section) and times reading and writing it the way the filter
+# did before (pf.load / pf.dump through the json module) and the way it does
+# now with every JSON backend installed (orjson, ujson, json):
+#   * panflute walk: load_doc (json's object_hook whatever the backend), then
+#     json_dumps(doc)
+#   * json walk: json_loads / json_dumps of the plain JSON tree
+# Peak memory of the output step is measured separately with tracemalloc.
+#
+# Usage: python bench/json_io.py [--sections 400] [--paragraphs 50] [--repeat 3]
+# -----------------------------------------------------------------------------
+import argparse
+import gc
+import io
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import panflute as pf  # noqa: E402
+import tikz2svg  # noqa: E402
+
+BACKENDS = [name for name, module in (("orjson", tikz2svg.orjson), ("ujson", tikz2svg.ujson),
+                                      ("json", json)) if module is not None]
+
+
+# -----------------------------------------------------------------------------
+# Synthetic document
+# -----------------------------------------------------------------------------
+def _inlines(words):
+    out = []
+    for i in range(words):
+        out.append({"t": "Str", "c": f"word{i}"})
+        out.append({"t": "Space"})
+    return out[:-1]
+
+
+def synthetic_ast(sections: int, paragraphs: int) -> str:
+    blocks = []
+    for s in range(sections):
+        blocks.append({"t": "Header", "c": [1 + s % 2, [f"sec-{s}", [], []], _inlines(3)]})
+        for _ in range(paragraphs):
+            blocks.append({"t": "Para", "c": _inlines(40)})
+        code = "\\begin{tikzpicture}\n\\draw (0,0) -- (%d,1);\n\\end{tikzpicture}" % s
+        blocks.append({"t": "Figure", "c": [
+            [f"fig-{s}", [], []],
+            [None, [{"t": "Plain", "c": _inlines(5)}]],
+            [{"t": "RawBlock", "c": ["latex", code]}],
+        ]})
+    return json.dumps({"pandoc-api-version": [1, 23, 1], "meta": {}, "blocks": blocks},
+                      separators=(",", ":"), ensure_ascii=False)
+
+
+# -----------------------------------------------------------------------------
+# Measurements
+# -----------------------------------------------------------------------------
+def best_of(repeat, fn):
+    best = float("inf")
+    for _ in range(repeat):
+        gc.collect()
+        gc.disable()  # like timeit: keep collections of the big tree out of the timings
+        try:
+            start = time.perf_counter()
+            fn()
+            best = min(best, time.perf_counter() - start)
+        finally:
+            gc.enable()
+    return best
+
+
+def peak_mib(fn):
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak / 1024 ** 2
+
+
+def old_dump(doc):
+    with io.StringIO() as out:
+        pf.dump(doc, out)
+        return out.getvalue().encode("utf-8")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sections", type=int, default=400)
+    parser.add_argument("--paragraphs", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    text = synthetic_ast(args.sections, args.paragraphs)
+    print(f"synthetic AST: {len(text) / 1024 ** 2:.1f} MiB, {args.sections} figures")
+    print(f"{'variant':34s} {'load s':>8s} {'dump s':>8s} {'dump peak MiB':>14s}")
+
+    doc = pf.load(io.StringIO(text))
+    load = best_of(args.repeat, lambda: pf.load(io.StringIO(text)))
+    dump = best_of(args.repeat, lambda: old_dump(doc))
+    print(f"{'panflute walk, pf.load/pf.dump':34s} {load:8.3f} {dump:8.3f} {peak_mib(lambda: old_dump(doc)):14.1f}")
+
+    expected = old_dump(doc)
+    load = best_of(args.repeat, lambda: tikz2svg.load_doc(text))  # object_hook, any backend
+    for backend in BACKENDS:
+        tikz2svg.JSON_BACKEND = backend
+        assert tikz2svg.json_dumps(doc) == expected, backend
+        dump = best_of(args.repeat, lambda: tikz2svg.json_dumps(doc))
+        peak = peak_mib(lambda: tikz2svg.json_dumps(doc))
+        print(f"{'panflute walk, ' + backend:34s} {load:8.3f} {dump:8.3f} {peak:14.1f}")
+
+    for backend in BACKENDS:
+        tikz2svg.JSON_BACKEND = backend
+        data = tikz2svg.json_loads(text)
+        load = best_of(args.repeat, lambda: tikz2svg.json_loads(text))
+        dump = best_of(args.repeat, lambda: tikz2svg.json_dumps(data))
+        peak = peak_mib(lambda: tikz2svg.json_dumps(data))
+        print(f"{'json walk, ' + backend:34s} {load:8.3f} {dump:8.3f} {peak:14.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# -----------------------------------------------------------------------------
+# pipeline.py — benchmark of the filter's own overhead, without TeX
+#
+# Runs tikz2svg.py end to end, the way pandoc does (JSON AST on stdin, output
+# format as argument), on generated documents with 10 to 10,000 pictures.
+# bench/stubs is put first on PATH, so lualatex and pdftocairo are stubs with
+# a configurable latency (BENCH_* variables, see the stubs) and the numbers
+# are reproducible on a machine without TeX. Each run gets a fresh working
+# directory and cache; timings come from the wall clock and from the
+# filter's build report (report option).
+#
+# Documents mix figures, centered divs, figures with two subfigures and bare
+# raw LaTeX pictures with noise: paragraphs, raw tables and equations, and a
+# header every few pictures. Scenarios:
+#   * cold: empty cache, every engine with jobs=1 and jobs=--jobs; the ratio
+#     is the parallel speedup (only for --cold-sizes, stub runs add up)
+#   * warm: the same document again, every picture from the store
+#   * shifted: a chapter inserted at the start, so every picture is renumbered
+#     and only relinked from the store
+#   * walk: the AST walk time reported by the filter (column "walk s"); the
+#     warm and shifted runs are done with the panflute and the json walk
+# Stub latencies are sleeps, so parallel speedups show even on few cores.
+#
+# Usage: python bench/pipeline.py [--sizes 10,100,1000,10000]
+#            [--cold-sizes 10,100] [--engines run,pages,daemon,batch]
+#            [--jobs 4] [--repeat 3]
+# -----------------------------------------------------------------------------
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+FILTER = os.path.join(ROOT, "tikz2svg.py")
+STUBS = os.path.join(ROOT, "bench", "stubs")
+
+
+# -----------------------------------------------------------------------------
+# Synthetic documents
+# -----------------------------------------------------------------------------
+def _inlines(text):
+    out = []
+    for word in text.split():
+        out += [{"t": "Str", "c": word}, {"t": "Space"}]
+    return out[:-1]
+
+
+def _raw(code):
+    return {"t": "RawBlock", "c": ["latex", code]}
+
+
+def _picture(i):
+    if i % 7 == 0:
+        return ("\\begin{circuitikz}[european]\n  \\draw (0,0) to[R=$R_{%d}$] (2,0) to[C] (2,-2)"
+                " to[battery1] (0,-2) -- (0,0);\n\\end{circuitikz}" % i)
+    lines = "".join(f"  \\draw ({k},0) -- ({k},{(i + k) % 5}) node[above] {{$x_{k}$}};\n"
+                    for k in range(3 + i % 5))
+    return "\\begin{tikzpicture}[scale=%d]\n%s\\end{tikzpicture}" % (1 + i % 3, lines)
+
+
+NOISE = [
+    "\\begin{tabular}{l|rr}\n" + "".join(f"row {k} & {k} & {k * k} \\\\\n" for k in range(12)) + "\\end{tabular}",
+    "\\begin{align}\n" + "".join(f"  f_{k}(x) &= x^{k} \\\\\n" for k in range(6)) + "\\end{align}",
+]
+
+
+def synthetic_doc(pictures: int, shifted: bool = False, seed: int = 1) -> bytes:
+    rng = random.Random(seed)
+    blocks = []
+    if shifted:
+        blocks += [{"t": "Header", "c": [1, ["preface", [], []], _inlines("Preface")]},
+                   {"t": "Para", "c": _inlines("An inserted chapter renumbers every picture.")}]
+    i = 0
+    while i < pictures:
+        if i % 40 == 0:
+            blocks.append({"t": "Header", "c": [1, [f"ch-{i}", [], []], _inlines(f"Chapter {i // 40 + 1}")]})
+        if i % 8 == 0:
+            blocks.append({"t": "Header", "c": [2, [f"sec-{i}", [], []], _inlines(f"Section {i // 8 + 1}")]})
+        for _ in range(3):
+            blocks.append({"t": "Para", "c": _inlines("Lorem ipsum dolor sit amet, consectetur " * 6)})
+        if rng.random() < 0.5:
+            blocks.append(_raw(rng.choice(NOISE)))
+
+        kind = rng.random()
+        caption = [None, [{"t": "Plain", "c": _inlines(f"Picture {i}")}]]
+        if kind < 0.1 and i + 1 < pictures:
+            parts = "\n\\hfill\n".join(
+                f"\\begin{{subfigure}}{{0.45\\textwidth}}\n{_picture(i + k)}\n"
+                f"\\caption{{Part {k}}}\\label{{fig:{i}-{k}}}\n\\end{{subfigure}}" for k in range(2))
+            blocks.append({"t": "Figure", "c": [[f"fig:{i}", [], []], caption, [_raw(parts)]]})
+            i += 2
+            continue
+        if kind < 0.6:
+            blocks.append({"t": "Figure", "c": [[f"fig:{i}", [], []], caption, [_raw(_picture(i))]]})
+        elif kind < 0.85:
+            blocks.append({"t": "Div", "c": [["", ["center"], []], [_raw(_picture(i))]]})
+        else:
+            blocks.append(_raw(_picture(i)))
+        i += 1
+    return json.dumps({"pandoc-api-version": [1, 23, 1], "meta": {}, "blocks": blocks}).encode("utf-8")
+
+
+# -----------------------------------------------------------------------------
+# Filter runs
+# -----------------------------------------------------------------------------
+def run_filter(doc: bytes, workdir: str, **options):
+    env = {key: value for key, value in os.environ.items() if not key.startswith("TIKZ2SVG_")}
+    env["PATH"] = STUBS + os.pathsep + env.get("PATH", "")
+    env["TIKZ2SVG_CACHE_DIR"] = os.path.join(workdir, "cache")
+    env["TIKZ2SVG_REPORT"] = os.path.join(workdir, "report.json")
+    for name, value in options.items():
+        env["TIKZ2SVG_" + name.upper()] = str(value)
+
+    start = time.perf_counter()
+    subprocess.run([sys.executable, FILTER, "markdown"], input=doc, cwd=workdir, env=env,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    wall = time.perf_counter() - start
+    with open(env["TIKZ2SVG_REPORT"], encoding="utf-8") as f:
+        report = json.load(f)
+    return wall, report
+
+
+def best_run(repeat, prepare, doc, **options):
+    best = None
+    for _ in range(repeat):
+        workdir = tempfile.mkdtemp(prefix="tikzbench_")
+        try:
+            prepare(workdir)
+            result = run_filter(doc, workdir, **options)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        if best is None or result[0] < best[0]:
+            best = result
+    return best
+
+
+def row(pictures, scenario, options, result):
+    wall, report = result
+    stages = report["stages"]
+    compiled = report["cache"]["misses"]
+    print(f"{pictures:8d} {scenario:9s} {options.get('engine', 'run'):7s} {options.get('jobs', 1):4d} "
+          f"{options.get('ast', 'panflute'):9s} {wall:8.2f} {stages.get('walk', 0):8.3f} "
+          f"{compiled:8d} {wall / pictures * 1e3:11.2f}")
+    return wall
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", default="10,100,1000,10000")
+    parser.add_argument("--cold-sizes", default="10,100")
+    parser.add_argument("--engines", default="run,pages,daemon,batch")
+    parser.add_argument("--jobs", type=int, default=4)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(",")]
+    cold_sizes = [int(size) for size in args.cold_sizes.split(",")]
+
+    print(f"{'pictures':>8s} {'scenario':9s} {'engine':7s} {'jobs':>4s} {'ast':9s} {'wall s':>8s} "
+          f"{'walk s':>8s} {'compiled':>8s} {'ms/picture':>11s}")
+    for pictures in sizes:
+        doc = synthetic_doc(pictures)
+
+        if pictures in cold_sizes:
+            for engine in args.engines.split(","):
+                walls = [row(pictures, "cold", options, best_run(1, lambda workdir: None, doc, **options))
+                         for options in ({"engine": engine, "jobs": 1}, {"engine": engine, "jobs": args.jobs})]
+                print(f"{'':8s} {'speedup':9s} {engine:7s} {args.jobs:4d} {'':9s} {walls[0] / walls[1]:7.1f}x")
+
+        # one cold run fills the cache that the warm runs start from
+        seed = tempfile.mkdtemp(prefix="tikzbench_seed_")
+        try:
+            run_filter(doc, seed, engine="batch", jobs=args.jobs)
+
+            def warm(workdir):
+                shutil.copytree(os.path.join(seed, "cache"), os.path.join(workdir, "cache"))
+                shutil.copytree(os.path.join(seed, "media"), os.path.join(workdir, "media"))
+
+            for ast in ("panflute", "json"):
+                options = {"jobs": args.jobs, "ast": ast}
+                row(pictures, "warm", options, best_run(args.repeat, warm, doc, **options))
+                row(pictures, "shifted", options,
+                    best_run(args.repeat, warm, synthetic_doc(pictures, shifted=True), **options))
+        finally:
+            shutil.rmtree(seed, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
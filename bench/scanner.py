@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# -----------------------------------------------------------------------------
+# scanner.py — microbenchmark of the TikZ environment scanner
+#
+# Compares scan_tikz with the previous detection, i.e. the keyword check
+# `any(k in text for k in (...))` followed by re.search/re.finditer with an
+# uncompiled pattern, on raw LaTeX blocks typical of lecture scripts:
+#   * tables and equations (no picture; the common case)
+#   * single tikzpicture / circuitikz blocks
+#   * blocks with several pictures (subfigures)
+#   * a picture inside a tikzpicture node, and a tikzpicture nested in one,
+#     where the old non-greedy pattern cuts the outer picture short
+#
+# Usage: python bench/scanner.py [--number 20000]
+# -----------------------------------------------------------------------------
+import argparse
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import tikz2svg  # noqa: E402
+
+KEYWORDS = ("tikzpicture", "circuitikz", "begin{picture}")
+OLD_PATTERN = (
+    r"\\begin\{(?P<env>tikzpicture|circuitikz|picture)\}.*?"
+    r"\\end\{(?P=env)\}"
+)
+
+
+def old_scan(text):
+    if not any(k in text for k in KEYWORDS):
+        return []
+    return [(m.start(), m.end(), m.group(0)) for m in re.finditer(OLD_PATTERN, text, re.S)]
+
+
+# -----------------------------------------------------------------------------
+# Sample blocks
+# -----------------------------------------------------------------------------
+TABLE = "\\begin{tabular}{l|rrr}\n" + "".join(
+    f"row {i} & {i} & {i * i} & \\textbf{{{i ** 3}}} \\\\\n" for i in range(40)) + "\\end{tabular}"
+EQUATION = "\\begin{align}\n" + "".join(
+    f"  f_{i}(x) &= \\int_0^x t^{i} \\, dt = \\frac{{x^{{{i + 1}}}}}{{{i + 1}}} \\\\\n" for i in range(20)) + "\\end{align}"
+TIKZ = ("\\begin{tikzpicture}[scale=1.5]\n" + "".join(
+    f"  \\draw[thick] ({i},0) -- ({i},1) node[above] {{$x_{i}$}};\n" for i in range(30)) + "\\end{tikzpicture}")
+CIRCUIT = ("\\begin{circuitikz}[european]\n  \\draw (0,0) to[R=$R_1$] (2,0) to[C=$C_1$] (2,-2)"
+           " to[battery1] (0,-2) -- (0,0);\n\\end{circuitikz}")
+SUBFIGURES = "\n\\hfill\n".join(
+    f"\\begin{{subfigure}}{{0.3\\textwidth}}\n{TIKZ}\n\\caption{{Part {i}}}\n\\end{{subfigure}}" for i in range(3))
+NESTED = ("\\begin{tikzpicture}\n  \\node at (0,0) {\\begin{picture}(10,10)\\put(0,0){x}\\end{picture}};\n"
+          "  \\node at (2,0) {\\begin{tikzpicture}\\draw (0,0) circle (1);\\end{tikzpicture}};\n"
+          "  \\draw (0,0) -- (2,0);\n\\end{tikzpicture}")
+
+SAMPLES = [
+    ("table", TABLE),
+    ("equation", EQUATION),
+    ("tikzpicture", TIKZ),
+    ("circuitikz", CIRCUIT),
+    ("3 subfigures", SUBFIGURES),
+    ("nested", NESTED),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--number", type=int, default=20000)
+    args = parser.parse_args()
+
+    print(f"{'block':14s} {'chars':>6s} {'old µs':>8s} {'new µs':>8s} {'speedup':>8s}  result")
+    for name, text in SAMPLES:
+        old = min(timeit.repeat(lambda: old_scan(text), number=args.number, repeat=3)) / args.number
+        new = min(timeit.repeat(lambda: tikz2svg.scan_tikz(text), number=args.number, repeat=3)) / args.number
+        old_found, new_found = old_scan(text), tikz2svg.scan_tikz(text)
+        result = "same" if old_found == new_found else (
+            f"old {[end - start for start, end, _ in old_found]} chars, "
+            f"new {[end - start for start, end, _ in new_found]} chars")
+        print(f"{name:14s} {len(text):6d} {old * 1e6:8.2f} {new * 1e6:8.2f} {old / new:7.1f}x  {result}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -----------------------------------------------------------------------------
+# scratch.py — benchmark of the scratch directories compiles run in
+#
+# Compares, for every scratch root (the current directory, i.e. the build
+# volume, the system temporary directory, /dev/shm and any --root given, e.g.
+# a network mount):
+#   * fresh: a TemporaryDirectory per job, as the filter did before
+#   * pooled: acquire_scratch / release_scratch, one directory per worker,
+#     emptied and reused between jobs
+# Each job does the file I/O of one compile: write t.tex, the aux, log and
+# PDF lualatex writes, the SVG pdftocairo writes, and moves the SVG into a
+# store directory on the build volume (move_file).
+# With --pictures, the whole filter is also run on a generated document
+# (bench/pipeline.py) with zero-latency stub tools and each root as
+# scratch-dir, so only the I/O differs.
+#
+# Usage: python bench/scratch.py [--jobs 2000] [--root /mnt/nfs/tmp ...]
+#            [--pictures 200]
+# -----------------------------------------------------------------------------
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import tikz2svg  # noqa: E402
+import pipeline  # noqa: E402
+
+FILES = (("t.tex", 2), ("t.aux", 1), ("t.log", 30), ("t.pdf", 40), ("t1.svg", 60))  # KiB
+
+
+def compile_io(tmp, store, n):
+    for name, kib in FILES:
+        with open(os.path.join(tmp, name), "wb") as f:
+            f.write(b"x" * (kib * 1024))
+    tikz2svg.move_file(os.path.join(tmp, "t1.svg"), os.path.join(store, f"{n}.svg"))
+
+
+def fresh(root, store, jobs):
+    for n in range(jobs):
+        with tempfile.TemporaryDirectory(prefix="tikz_", dir=root) as tmp:
+            compile_io(tmp, store, n)
+
+
+def pooled(root, store, jobs):
+    for n in range(jobs):
+        with tikz2svg.scratch_dir(root) as tmp:
+            compile_io(tmp, store, n)
+    tikz2svg.remove_scratch()
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--jobs", type=int, default=2000)
+    parser.add_argument("--root", action="append", default=[], help="additional scratch root to compare")
+    parser.add_argument("--pictures", type=int, default=0, help="also run the filter on this many pictures")
+    args = parser.parse_args()
+
+    roots = [os.getcwd(), tempfile.gettempdir()] + \
+        ([tikz2svg.SHM_PATH] if tikz2svg.default_scratch_root() else []) + args.root
+    roots = list(dict.fromkeys(roots))
+    store = tempfile.mkdtemp(prefix="tikzbench_store_", dir=os.getcwd())
+    try:
+        print(f"{'scratch root':28s} {'fresh µs/job':>13s} {'pooled µs/job':>14s} {'saved':>6s}")
+        for root in roots:
+            before = timed(fresh, root, store, args.jobs) / args.jobs
+            after = timed(pooled, root, store, args.jobs) / args.jobs
+            print(f"{root:28s} {before * 1e6:13.0f} {after * 1e6:14.0f} {1 - after / before:6.0%}")
+    finally:
+        shutil.rmtree(store, ignore_errors=True)
+
+    if args.pictures:
+        doc = pipeline.synthetic_doc(args.pictures)
+        os.environ.update(BENCH_LUALATEX_LOAD="0", BENCH_LUALATEX_RUN="0", BENCH_LUALATEX_PAGE="0",
+                          BENCH_PDFTOCAIRO="0")
+        print(f"\n{'scratch root':28s} {'filter s':>9s}  ({args.pictures} pictures, cold, stub tools)")
+        for root in roots:
+            wall, _ = pipeline.best_run(3, lambda workdir: None, doc, scratch_dir=root, jobs=4)
+            print(f"{root:28s} {wall:9.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -----------------------------------------------------------------------------
+# toolchain.py — benchmark of the real TeX toolchain on bench/corpus
+#
+# bench/corpus holds representative pictures written against the libraries
+# DOC_PREAMBLE loads: circuitikz (european, straight voltages, siunitx),
+# automata, positioning, arrows and circuits.ee.IEC. Needs lualatex,
+# pdftocairo and mylatexformat (TeX Live) on PATH.
+#   * per picture: the black variant compiled the way the "run" engine does,
+#     once loading the preamble and once with the precompiled format; reports
+#     lualatex and pdftocairo time (best of --repeat), SVG size and peak RSS
+#     of lualatex (os.wait4)
+#   * per engine: the whole corpus (black and white variants) through
+#     compile_jobs with a fresh store and a shared format; reports wall time,
+#     the stage totals of the build report and the peak RSS of all children,
+#     and how many SVGs differ in size (width/height) from the "run" engine's,
+#     i.e. were cropped differently by the multi-page template
+#
+# Usage: python bench/toolchain.py [--repeat 3] [--jobs 4] [--engines run,pages,daemon,batch]
+#            [--corpus bench/corpus]
+# -----------------------------------------------------------------------------
+import argparse
+import glob
+import os
+import re
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import tikz2svg  # noqa: E402
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus")
+SIZE_RE = re.compile(rb'<svg[^>]*?width="([^"]*)"[^>]*?height="([^"]*)"')
+
+
+def measured(cmd, cwd, env=None):
+    start = time.perf_counter()
+    proc = subprocess.Popen(cmd, cwd=cwd, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = proc.stdout.read()
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    proc.stdout.close()
+    if proc.returncode != 0:
+        raise RuntimeError(f"{cmd[0]} failed:\n{output.decode('utf-8', errors='ignore')[-600:]}")
+    return time.perf_counter() - start, usage.ru_maxrss / 1024  # ru_maxrss is KiB on Linux
+
+
+def compile_once(code, fmt):
+    cmd, env = tikz2svg._lualatex_command(fmt)
+    body = tikz2svg.DOC_BODY % (tikz2svg.STYLE_BLACK, code)
+    with tempfile.TemporaryDirectory(prefix="tikzbench_") as tmp:
+        with open(os.path.join(tmp, "t.tex"), "w", encoding="utf-8") as f:
+            f.write(tikz2svg.FORMAT_BODY_PREFIX + body if fmt else tikz2svg.DOC_HEAD + body)
+        lualatex, rss = measured(cmd + ["-output-directory", tmp, "t.tex"], tmp, env)
+        pdftocairo, _ = measured(["pdftocairo", "-svg", "t.pdf", "t.svg"], tmp)
+        return lualatex, pdftocairo, os.path.getsize(os.path.join(tmp, "t.svg")), rss
+
+
+def per_picture(corpus, fmt, repeat):
+    print(f"\n{'picture':22s} {'mode':9s} {'lualatex s':>10s} {'pdftocairo s':>12s} "
+          f"{'SVG KiB':>8s} {'peak RSS MiB':>12s}")
+    for mode, mode_fmt in (("preamble", None), ("format", fmt)):
+        for name, code in corpus:
+            runs = [compile_once(code, mode_fmt) for _ in range(repeat)]
+            lualatex = min(run[0] for run in runs)
+            pdftocairo = min(run[1] for run in runs)
+            size, rss = runs[0][2], max(run[3] for run in runs)
+            print(f"{name:22s} {mode:9s} {lualatex:10.3f} {pdftocairo:12.3f} {size / 1024:8.1f} {rss:12.1f}")
+
+
+def svg_size(path):
+    try:
+        with open(path, "rb") as f:
+            match = SIZE_RE.search(f.read(4096))
+    except OSError:
+        return None
+    return match and match.groups()
+
+
+def per_engine(corpus, formats, engines, jobs):
+    print(f"\n{'engine':7s} {'jobs':>4s} {'wall s':>8s} {'lualatex s':>10s} {'pdftocairo s':>12s} {'failed':>6s} "
+          f"{'size!=run':>9s}")
+    sizes = {}
+    for engine in engines:
+        with tempfile.TemporaryDirectory(prefix="tikzbench_") as tmp:
+            shutil.copytree(formats, os.path.join(tmp, "cache", "formats"))
+            options = tikz2svg.FilterOptions(jobs=jobs, engine=engine, cache_dir=os.path.join(tmp, "cache"))
+            pictures = [tikz2svg.TikzJob(code=code, black_svg=os.path.join(tmp, f"{name}_black.svg"),
+                                         white_svg=os.path.join(tmp, f"{name}_white.svg"),
+                                         adaptive_svg=os.path.join(tmp, f"{name}.svg"), label=name)
+                     for name, code in corpus]
+            tikz2svg.reset_report()
+            start = time.perf_counter()
+            tikz2svg.compile_jobs(pictures, options)
+            wall = time.perf_counter() - start
+            report = tikz2svg.build_report(options)
+            sizes[engine] = {picture.black_svg[len(tmp):]: svg_size(picture.black_svg) for picture in pictures}
+            differing = sum(size != sizes["run"].get(name) for name, size in sizes[engine].items()) \
+                if "run" in sizes else "-"
+            print(f"{engine:7s} {jobs:4d} {wall:8.2f} {report['stages'].get('lualatex', 0):10.2f} "
+                  f"{report['stages'].get('pdftocairo', 0):12.2f} {report['cache']['failed']:6d} {differing:>9}")
+    rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    print(f"peak RSS of any tool run: {rss:.1f} MiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--corpus", default=CORPUS)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--jobs", type=int, default=4)
+    parser.add_argument("--engines", default="run,pages,daemon,batch")
+    args = parser.parse_args()
+    for tool in ("lualatex", "pdftocairo"):
+        if shutil.which(tool) is None:
+            sys.exit(f"{tool} not found on PATH")
+
+    corpus = []
+    for path in sorted(glob.glob(os.path.join(args.corpus, "*.tex"))):
+        with open(path, encoding="utf-8") as f:
+            corpus.append((os.path.splitext(os.path.basename(path))[0], f.read().strip()))
+    print(f"{len(corpus)} pictures, {tikz2svg.tool_version('lualatex')}")
+
+    with tempfile.TemporaryDirectory(prefix="tikzbench_fmt_") as formats:
+        start = time.perf_counter()
+        fmt = tikz2svg.precompiled_format(tikz2svg.DOC_HEAD, formats)
+        tikz2svg.precompiled_format(tikz2svg.PAGES_HEAD, formats)
+        print(f"format dumps: {time.perf_counter() - start:.2f} s" if fmt else "format dump failed")
+        per_picture(corpus, fmt, args.repeat)
+        per_engine(corpus, formats, args.engines.split(","), args.jobs)
+
+
+if __name__ == "__main__":
+    main()
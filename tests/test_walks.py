@@ -0,0 +1,74 @@
+# -----------------------------------------------------------------------------
+# test_walks.py — the "json" ast must produce the same output as panflute
+#
+# Runs tikz2svg.py the way pandoc does on small documents, once per ast, with
+# the stub lualatex and pdftocairo from bench/stubs, and compares the output
+# JSON and the media files written.
+#
+# Usage: python -m pytest tests
+# -----------------------------------------------------------------------------
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+FILTER = os.path.join(ROOT, "tikz2svg.py")
+STUBS = os.path.join(ROOT, "bench", "stubs")
+sys.path.insert(0, os.path.join(ROOT, "bench"))
+import pipeline  # noqa: E402
+
+
+def _picture(n):
+    return "\\begin{tikzpicture}\\draw (0,0) -- (%d,1);\\end{tikzpicture}" % n
+
+
+def _doc(blocks):
+    return json.dumps({"pandoc-api-version": [1, 23, 1], "meta": {}, "blocks": blocks}).encode("utf-8")
+
+
+CAPTION_DOC = _doc([
+    {"t": "Header", "c": [1, ["a", [], []], [{"t": "Str", "c": "A"}]]},
+    {"t": "Header", "c": [2, ["b", [], []], [{"t": "Str", "c": "B"}]]},
+    {"t": "Figure", "c": [["fig:x", [], []],
+                          [None, [{"t": "Plain", "c": [{"t": "Str", "c": "Cap"}, {"t": "Space"},
+                                                       {"t": "RawInline", "c": ["latex", _picture(1)]}]}]],
+                          [{"t": "RawBlock", "c": ["latex", _picture(2)]}]]},
+    {"t": "Div", "c": [["", ["center"], []],
+                       [{"t": "Para", "c": [{"t": "RawInline", "c": ["latex", _picture(3)]}]},
+                        {"t": "RawBlock", "c": ["latex", _picture(4)]}]]},
+    {"t": "Para", "c": [{"t": "Str", "c": "See"}, {"t": "Space"},
+                        {"t": "RawInline", "c": ["latex", _picture(5)]}]},
+])
+
+
+# many picture-less figures after the pictures, so that the ids of elements
+# freed during the json walk are reused for later ones
+IMAGES_DOC = _doc(
+    [{"t": "Figure", "c": [[f"fig:{n}", [], []], [None, []], [{"t": "RawBlock", "c": ["latex", _picture(n)]}]]}
+     for n in range(5)]
+    + [{"t": "Figure", "c": [[f"img{n}", [], []], [None, [{"t": "Plain", "c": [{"t": "Str", "c": f"Image {n}"}]}]],
+                             [{"t": "Plain", "c": [{"t": "Image", "c": [["", [], []], [], [f"img{n}.png", ""]]}]}]]}
+       for n in range(500)])
+
+
+def _run(doc, workdir, ast):
+    env = {key: value for key, value in os.environ.items() if not key.startswith("TIKZ2SVG_")}
+    env.update(PATH=STUBS + os.pathsep + env.get("PATH", ""), TIKZ2SVG_AST=ast,
+               BENCH_LUALATEX_LOAD="0", BENCH_LUALATEX_RUN="0", BENCH_LUALATEX_PAGE="0", BENCH_PDFTOCAIRO="0")
+    out = subprocess.run([sys.executable, FILTER, "markdown"], input=doc, cwd=workdir, env=env,
+                         stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout
+    return json.loads(out), sorted(os.listdir(os.path.join(workdir, "media")))
+
+
+@pytest.mark.parametrize("doc", [CAPTION_DOC, IMAGES_DOC, pipeline.synthetic_doc(40)],
+                         ids=["caption", "images", "synthetic"])
+def test_json_walk_matches_panflute(doc, tmp_path):
+    results = {}
+    for ast in ("panflute", "json"):
+        workdir = tmp_path / ast
+        workdir.mkdir()
+        results[ast] = _run(doc, workdir, ast)
+    assert results["json"] == results["panflute"]
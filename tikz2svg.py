@@ -24,6 +24,21 @@
 # os: filesystem operations
 # re: regex extraction of tikz environments
 # sys: error reporting to stderr
+# concurrent.futures: bounded worker pool driving the compile subprocesses
+# dataclasses: lightweight record for collected compile jobs
+# functools: bind compile tasks for the worker pool, memoize tool versions
+# threading: serialize the one-time format dump between pool workers
+# queue / collections / shutil / time: persistent TeX worker plumbing
+# socket: host name recorded in cross-process claim markers
+# argparse: command-line interface of the maintenance subcommands
+# html: escape compile errors shown in placeholder SVGs
+# io / json: pandoc's JSON AST, read directly by watch mode and the "json" walk
+# contextlib: timed stages of the build report, scratch directory checkout
+# atexit: remove the pooled scratch directories
+# signal: remove them on SIGTERM as well, which skips the atexit handlers
+# sqlite3 (optional): cache index; the index is skipped if it is unavailable
+# orjson / ujson (optional): faster reading and writing of the AST; json is
+#   used if neither is installed
 import panflute as pf
 import hashlib
 import tempfile
@@ -31,29 +46,104 @@ import subprocess
 import os
 import re
 import sys
+import concurrent.futures
+import functools
+import threading
+import queue
+import collections
+import shutil
+import time
+import socket
+import argparse
+import html
+import io
+import json
+import contextlib
+import atexit
+import signal
+from dataclasses import dataclass
+
+try:
+    import sqlite3
+except ImportError:  # Python built without sqlite
+    sqlite3 = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
 
 # -----------------------------------------------------------------------------
 # Configuration / constants
+# - FILTER_VERSION: version of the rendering pipeline; part of every cache
+#   key, so bump it whenever a change alters the generated SVGs
 # - MEDIA_PATH: directory to place generated images (relative)
-# - DOC_TEMPLATE: minimal standalone LaTeX wrapper used to compile TikZ code
+# - CACHE_PATH: default directory for build artifacts that are not published
+#   (precompiled formats, content-addressed SVG store); see the cache-dir
+#   option for sharing one cache between projects
+# - CLAIM_STALE_SECONDS: age after which another process' claim on a cache
+#   entry is considered abandoned
+# - DOC_PREAMBLE: packages and libraries shared by all templates
+# - DOC_HEAD / DOC_BODY (= DOC_TEMPLATE): minimal standalone LaTeX wrapper used
+#   to compile TikZ code, split at the end of the preamble so the head can be
+#   dumped into a precompiled format
+# - PAGES_HEAD / PAGES_BODY (= PAGES_TEMPLATE) / PAGE_TEMPLATE: multi-page
+#   wrapper, one page per (code, style) pair, used by the "pages" engine
 # - STYLE_BLACK / STYLE_WHITE: small TikZ style adjustments to force
 #   monochrome rendering suitable for theme-specific images
 # -----------------------------------------------------------------------------
+FILTER_VERSION = "3"
 MEDIA_PATH = "media"
+CACHE_PATH = ".tikz2svg-cache"
+CLAIM_STALE_SECONDS = 900
 
-DOC_TEMPLATE = r"""
-\documentclass[border=2pt]{standalone}
+DOC_PREAMBLE = r"""
 \usepackage{tikz}
 \usepackage[siunitx, straight voltages, european]{circuitikz}
 \usetikzlibrary{automata, positioning, arrows, circuits.ee.IEC}
 \ctikzset{>=latex, tripoles/european not symbol=ieee circle}
+"""
 
+DOC_HEAD = r"""
+\documentclass[border=2pt]{standalone}""" + DOC_PREAMBLE
+
+DOC_BODY = r"""
 %s
 \begin{document}
 %s
 \end{document}
 """
 
+DOC_TEMPLATE = DOC_HEAD + DOC_BODY
+
+# Multi-page variant: every tikzpage environment becomes its own cropped page,
+# so several pictures/styles can share one lualatex run. The style goes inside
+# the environment, where the \tikzset stays local to that page. The page is
+# typeset in horizontal mode, so its lines end with % to keep the line ends
+# from adding spaces that would widen the crop.
+PAGES_HEAD = r"""
+\documentclass[border=2pt,multi=tikzpage]{standalone}""" + DOC_PREAMBLE + r"""\newenvironment{tikzpage}{}{}
+"""
+
+PAGES_BODY = r"""
+\begin{document}
+%s
+\end{document}
+"""
+
+PAGES_TEMPLATE = PAGES_HEAD + PAGES_BODY
+
+PAGE_TEMPLATE = r"""\begin{tikzpage}%%
+%s%%
+%s%%
+\end{tikzpage}
+"""
+
 STYLE_BLACK = r"\tikzset{every node/.style={text=black,fill=none},every path/.style={draw=black,fill=none}}"
 STYLE_WHITE = r"\tikzset{every node/.style={text=white,fill=none},every path/.style={draw=white,fill=none}}"
 
@@ -62,6 +152,9 @@ STYLE_WHITE = r"\tikzset{every node/.style={text=white,fill=none},every path/.st
 # Utility helpers
 # - sha1_hash: content-based stable id for filenames
 # - sanitize_number: turn header number lists into underscore-separated strings
+# - move_file: os.replace that also works across filesystems (temporary dirs
+#   often live on a different mount than the media/cache directories); the
+#   target is still replaced atomically.
 # -----------------------------------------------------------------------------
 def sha1_hash(text: str) -> str:
     return hashlib.sha1(text.encode("utf-8")).hexdigest()
@@ -71,62 +164,1162 @@ def sanitize_number(nums):
     return "0" if not nums else "_".join(str(n) for n in nums)
 
 
+def move_file(src: str, dst: str):
+    try:
+        os.replace(src, dst)
+    except OSError:
+        tmp = f"{dst}.{os.getpid()}.tmp"
+        shutil.copyfile(src, tmp)
+        os.replace(tmp, dst)
+        os.remove(src)
+
+
+# -----------------------------------------------------------------------------
+# Cross-process claims
+# - Several filter processes (e.g. `make -j` over chapters) may share one cache
+#   directory. Before producing a cache entry a process claims it by creating
+#   `<entry>.lock` exclusively; other processes wanting the same entry wait for
+#   the claim to go away and then pick up the published result instead of
+#   compiling it again. Entries themselves are always published atomically.
+# - A claim is stale when its owner (host + pid) is gone, or, for owners on
+#   other hosts, when it is older than CLAIM_STALE_SECONDS.
+# - The marker also holds a random token, kept in _claims while the claim is
+#   held: release_entry only removes a marker that still carries it, not one
+#   another process created after taking over the claim as stale.
+# -----------------------------------------------------------------------------
+_claims = {}  # path -> content of the marker this process created
+
+
+def _claim_is_stale(marker: str) -> bool:
+    try:
+        age = time.time() - os.path.getmtime(marker)
+        with open(marker, encoding="utf-8") as f:
+            host, pid = f.read().split()[:2]
+    except (OSError, ValueError):
+        return False  # gone (the caller retries) or still being written
+    if age > CLAIM_STALE_SECONDS:
+        return True
+    if os.name == "posix" and host == socket.gethostname() and pid.isdigit():
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return True
+        except OSError:
+            pass
+    return False
+
+
+def claim_entry(path: str) -> bool:
+    marker = path + ".lock"
+    while True:
+        try:
+            fd = os.open(marker, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if not _claim_is_stale(marker):
+                return False
+            try:
+                os.remove(marker)
+            except FileNotFoundError:
+                pass
+            continue
+        content = f"{socket.gethostname()} {os.getpid()} {os.urandom(8).hex()}\n"
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(content)
+        _claims[path] = content
+        return True
+
+
+def release_entry(path: str):
+    content = _claims.pop(path, None)
+    try:
+        with open(path + ".lock", encoding="utf-8") as f:
+            if f.read() != content:
+                return  # taken over as stale by another process
+        os.remove(path + ".lock")
+    except FileNotFoundError:
+        pass
+
+
+def wait_for_entry(path: str):
+    marker = path + ".lock"
+    while os.path.exists(marker) and not _claim_is_stale(marker):
+        time.sleep(0.2)
+
+
+# -----------------------------------------------------------------------------
+# Filter options
+# - get_option: look up a filter option, first in the document metadata
+#   (`tikz2svg-<name>`, e.g. `pandoc -M tikz2svg-jobs=8`), then in the
+#   environment (`TIKZ2SVG_<NAME>`). Pandoc passes no arguments of our own to a
+#   filter, so these are the only two channels available.
+# - get_jobs: size of the compile worker pool (the filter's `-j`).
+# - get_engine: how pictures are compiled; "run" (one lualatex run per
+#   picture and style), "pages" (one run per picture, one page per style),
+#   "daemon" (persistent TeX workers fed over a pipe) or "batch" (one run for
+#   all pictures, one page per picture and style).
+# - timeout / daemon-pages: seconds a daemon worker may spend on a picture,
+#   and pictures a worker typesets before it is retired.
+# - get_output: what is emitted per picture; "pair" (black and white SVGs in
+#   two theme-switched divs) or "adaptive" (one currentColor SVG, inlined).
+# - cache-dir: cache directory (default CACHE_PATH); point several projects
+#   at one directory to share formats and compiled SVGs between them.
+# - cache-max-size / cache-max-age: evict least recently used store entries
+#   at the end of a run until the store fits (e.g. "2G", "30d"); unset = keep.
+# - gc: what to do at the end of a run with numbered media SVGs that no
+#   document references any more; "off", "report" or "delete" ("delete"
+#   only with the document option set, else "report").
+# - document: name under which this document's media references are recorded
+#   (one manifest per document, so documents sharing MEDIA_PATH keep each
+#   other's files alive).
+# - ast: how the document is walked; "panflute" (default, the whole AST as
+#   panflute objects) or "json" (plain JSON, only the nodes the filter looks
+#   at become panflute objects; see "JSON fast path").
+# - retry-failed (flag): compile pictures again whose previous compile failed
+#   (see "Failed compiles"); by default they are skipped until they change.
+# - report: path of a JSON build report written at the end of a run (per
+#   picture stage timings, cache hits, output sizes; see "Build report");
+#   report-top: number of slowest pictures also summarized on stderr.
+# - metrics: path of a Prometheus textfile (.prom) with the run's numbers.
+# - trace: path of a Chrome Trace Event file of the run (every compile stage
+#   of every picture on its worker thread), to be opened in Perfetto.
+# - scratch-dir: root of the directories compiles run in (see "Scratch
+#   directories"); default /dev/shm if writable, else the system temp dir.
+# - format (flag, default on): compile against a precompiled format of the
+#   template preamble instead of loading the packages in every run.
+# - read_options: gather all options into a FilterOptions record, stored on
+#   the doc by prepare() and handed to the compile pipeline.
+# -----------------------------------------------------------------------------
+ENGINES = ("run", "pages", "daemon", "batch")
+OUTPUTS = ("pair", "adaptive")
+GC_MODES = ("off", "report", "delete")
+ASTS = ("panflute", "json")
+
+
+@dataclass
+class FilterOptions:
+    jobs: int = 1
+    engine: str = "run"
+    recolor: bool = False
+    output: str = "pair"
+    format: bool = True
+    timeout: float = 120.0
+    daemon_pages: int = 64
+    cache_dir: str = CACHE_PATH
+    cache_max_size: float = None  # bytes
+    cache_max_age: float = None  # seconds
+    gc: str = "off"
+    document: str = "default"
+    retry_failed: bool = False
+    ast: str = "panflute"
+    report: str = None
+    report_top: int = 10
+    trace: str = None
+    metrics: str = None
+    scratch_dir: str = None  # None: system temporary directory
+
+
+def get_option(doc, name, default=None):
+    value = None
+    if doc is not None:
+        value = doc.get_metadata(f"tikz2svg-{name}", None)
+    if value is None:
+        value = os.environ.get("TIKZ2SVG_" + name.upper().replace("-", "_"))
+    return default if value in (None, "") else value
+
+
+def get_flag(doc, name, default=False):
+    value = get_option(doc, name, default)
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes", "on")
+    return bool(value)
+
+
+def get_number(doc, name, default, cast=int):
+    try:
+        return cast(get_option(doc, name, default))
+    except (TypeError, ValueError):
+        sys.stderr.write(f"[tikz2svg] invalid value for '{name}', using {default}\n")
+        return default
+
+
+def _parse_unit(value, units, name):
+    if value is None:
+        return None
+    text = str(value).strip().lower()
+    scale = units.get(text[-1:], None)
+    try:
+        return float(text[:-1] if scale else text) * (scale or 1)
+    except ValueError:
+        sys.stderr.write(f"[tikz2svg] invalid {name} '{value}', ignored\n")
+        return None
+
+
+def parse_size(value):
+    return _parse_unit(value, {"k": 1024, "m": 1024 ** 2, "g": 1024 ** 3, "t": 1024 ** 4}, "size")
+
+
+def parse_age(value):
+    return _parse_unit(value, {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}, "age")
+
+
+def get_jobs(doc):
+    return max(1, get_number(doc, "jobs", os.cpu_count() or 1))
+
+
+def get_engine(doc):
+    engine = str(get_option(doc, "engine", "run")).lower()
+    if engine not in ENGINES:
+        sys.stderr.write(f"[tikz2svg] unknown engine '{engine}', using 'run'\n")
+        engine = "run"
+    return engine
+
+
+def get_output(doc):
+    output = str(get_option(doc, "output", "pair")).lower()
+    if output not in OUTPUTS:
+        sys.stderr.write(f"[tikz2svg] unknown output '{output}', using 'pair'\n")
+        output = "pair"
+    return output
+
+
+def get_ast(doc):
+    ast = str(get_option(doc, "ast", "panflute")).lower()
+    if ast not in ASTS:
+        sys.stderr.write(f"[tikz2svg] unknown ast '{ast}', using 'panflute'\n")
+        ast = "panflute"
+    return ast
+
+
+def get_gc(doc):
+    gc = str(get_option(doc, "gc", "off")).lower()
+    if gc in ("false", "0", "no"):
+        gc = "off"
+    if gc not in GC_MODES:
+        sys.stderr.write(f"[tikz2svg] unknown gc mode '{gc}', using 'off'\n")
+        gc = "off"
+    if gc == "delete" and get_option(doc, "document") is None:
+        # every document would record its media under "default", so one
+        # chapter's run would delete the media of all the others
+        sys.stderr.write("[tikz2svg] gc 'delete' needs the document option set, using 'report'\n")
+        gc = "report"
+    return gc
+
+
+def get_scratch(doc):
+    root = get_option(doc, "scratch-dir")
+    return os.path.expanduser(str(root)) if root is not None else default_scratch_root()
+
+
+def read_options(doc):
+    return FilterOptions(
+        jobs=get_jobs(doc),
+        engine=get_engine(doc),
+        recolor=get_flag(doc, "recolor"),
+        output=get_output(doc),
+        format=get_flag(doc, "format", True),
+        timeout=get_number(doc, "timeout", 120.0, float),
+        daemon_pages=max(1, get_number(doc, "daemon-pages", 64)),
+        cache_dir=os.path.expanduser(str(get_option(doc, "cache-dir", CACHE_PATH))),
+        cache_max_size=parse_size(get_option(doc, "cache-max-size")),
+        cache_max_age=parse_age(get_option(doc, "cache-max-age")),
+        gc=get_gc(doc),
+        document=re.sub(r"[^\w.-]", "_", str(get_option(doc, "document", "default"))),
+        retry_failed=get_flag(doc, "retry-failed"),
+        ast=get_ast(doc),
+        report=get_option(doc, "report"),
+        report_top=max(0, get_number(doc, "report-top", 10)),
+        trace=get_option(doc, "trace"),
+        metrics=get_option(doc, "metrics"),
+        scratch_dir=get_scratch(doc),
+    )
+
+
 # -----------------------------------------------------------------------------
 # TikZ extraction helper
-# - extract_tikz: finds first tikz/circuitikz/picture environment inside a
-#   string containing LaTeX code. Returns the full matched block or None.
+# - scan_tikz: one pass of a precompiled pattern over the \begin/\end of the
+#   tikzpicture/circuitikz/picture environments, tracking nesting on a stack.
+#   Returns every outermost environment as (start, end, code), in order; a
+#   figure with subfigures or a block with two circuits yields several, while
+#   a picture inside a tikzpicture node (or a tikzpicture nested in another)
+#   stays part of its parent. An environment that is never closed is skipped
+#   and the text after its \begin scanned again.
+# - extract_tikz: first environment found by scan_tikz, or None.
+# - subcaption: the \caption/\subcaption and \label following a picture (up
+#   to the next one), as written inside a subfigure/minipage.
 # - This isolates the TikZ snippet to be wrapped and compiled.
 # -----------------------------------------------------------------------------
+# the pattern starts with a literal "{", which the regex engine scans for much
+# faster than for the backslashes tables and equations are full of
+_TIKZ_ENV_RE = re.compile(r"\{(tikzpicture|circuitikz|picture)\}")
+
+
+def scan_tikz(raw: str):
+    first = _TIKZ_ENV_RE.search(raw)
+    if first is None:
+        return []  # most raw blocks: tables, equations
+    found, pos = [], first.start()
+    while True:
+        stack = []  # (env, start) of the open environments
+        for m in _TIKZ_ENV_RE.finditer(raw, pos):
+            env, brace = m.group(1), m.start()
+            if brace >= 6 and raw.startswith("\\begin", brace - 6):
+                stack.append((env, brace - 6))
+            elif brace >= 4 and raw.startswith("\\end", brace - 4) and any(open_env == env for open_env, _ in stack):
+                while True:
+                    open_env, start = stack.pop()
+                    if open_env == env:
+                        break
+                if not stack:
+                    found.append((start, m.end(), raw[start:m.end()]))
+        if not stack:
+            return found
+        pos = stack[0][1] + 7  # never closed: rescan after its "\\begin{"
+
+
 def extract_tikz(raw: str):
-    pattern = (
-        r"\\begin\{(?P<env>tikzpicture|circuitikz|picture)\}.*?"
-        r"\\end\{(?P=env)\}"
-    )
-    m = re.search(pattern, raw, re.S)
-    return m.group(0) if m else None
+    found = scan_tikz(raw)
+    return found[0][2] if found else None
+
+
+def _braced(text: str, pos: int):
+    # argument of a macro: text[pos] is "{"; returns its content or None
+    depth = 0
+    for i in range(pos, len(text)):
+        if text[i] == "{":
+            depth += 1
+        elif text[i] == "}":
+            depth -= 1
+            if depth == 0:
+                return text[pos + 1:i]
+    return None
+
+
+def subcaption(segment: str):
+    caption = label = ""
+    m = re.search(r"\\(?:sub)?caption\*?\s*(?:\[[^\]]*\])?\s*(?=\{)", segment)
+    if m:
+        caption = " ".join((_braced(segment, m.end()) or "").split())
+    m = re.search(r"\\label\s*\{([^}]*)\}", segment)
+    if m:
+        label = m.group(1).strip()
+    return caption, label
 
 
 # -----------------------------------------------------------------------------
-# Compilation helper
-# - compile_tikz_to_svg: create a temporary LaTeX file, run lualatex to produce
-#   a PDF, then call pdftocairo to produce an SVG. Moves final SVG to target.
-# - Behavior: suppress stdout to avoid polluting Pandoc; capture stderr and emit a
-#   trimmed message to sys.stderr on errors (keeps Pandoc JSON clean).
+# Toolchain and precompiled formats
+# - tool_version: first line of `<tool> --version` (memoized); part of every
+#   key that must change when TeX Live or Poppler is updated.
+# - precompiled_format: path of a .fmt holding `head` (documentclass and
+#   preamble) already loaded, or None if it cannot be built. Formats are
+#   dumped once with mylatexformat into `formats_dir` (<cache-dir>/formats),
+#   named by a hash of the head and the lualatex version, so a changed preamble
+#   or toolchain gets a fresh format automatically. Concurrent workers, and
+#   other processes sharing the cache, wait for the first dump. The dump runs
+#   in a scratch directory (see "Scratch directories").
 # -----------------------------------------------------------------------------
-def compile_tikz_to_svg(code: str, out_svg: str, style: str) -> bool:
-    full_doc = DOC_TEMPLATE % (style, code)
+FORMAT_BODY_PREFIX = "\\csname endofdump\\endcsname\n"
+
+_formats = {}
+_formats_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=None)
+def tool_version(tool: str, flag: str = "--version") -> str:
     try:
-        with tempfile.TemporaryDirectory(prefix="tikz_") as tmp:
-            tex_path = os.path.join(tmp, "t.tex")
-            pdf_path = os.path.join(tmp, "t.pdf")
-            svg_path = os.path.join(tmp, "t.svg")
-            with open(tex_path, "w", encoding="utf-8") as f:
-                f.write(full_doc)
+        proc = subprocess.run([tool, flag], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError:
+        return ""
+    out = (proc.stdout or proc.stderr).decode("utf-8", errors="ignore").strip()
+    return out.splitlines()[0] if out else ""
 
+
+def _build_format(head: str, formats_dir: str, scratch=None):
+    name = "tikz2svg-" + sha1_hash(head + tool_version("lualatex"))[:16]
+    fmt_dir = os.path.abspath(formats_dir)
+    fmt_path = os.path.join(fmt_dir, name + ".fmt")
+    if os.path.exists(fmt_path):
+        return fmt_path
+
+    owned = False
+    try:
+        os.makedirs(fmt_dir, exist_ok=True)
+        while not claim_entry(fmt_path):
+            wait_for_entry(fmt_path)
+            if os.path.exists(fmt_path):
+                return fmt_path
+            # the other dump failed; try ourselves unless a third process was faster
+        owned = True
+        with timed_stage("format"), scratch_dir(scratch) as tmp:
+            with open(os.path.join(tmp, "preamble.tex"), "w", encoding="utf-8") as f:
+                f.write(head + "\\begin{document}\n\\end{document}\n")
             subprocess.run(
-                ["lualatex", "-halt-on-error", "-interaction=nonstopmode",
-                 "-output-directory", tmp, tex_path],
-                check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+                ["lualatex", "-ini", "-halt-on-error", "-interaction=nonstopmode",
+                 f"-jobname={name}", "&lualatex", "mylatexformat.ltx", "preamble.tex"],
+                cwd=tmp, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
             )
+            move_file(os.path.join(tmp, name + ".fmt"), fmt_path)
+        return fmt_path
+
+    except subprocess.CalledProcessError as e:
+        msg = e.stderr.decode("utf-8", errors="ignore")[-400:]
+        sys.stderr.write(f"[tikz2svg] format dump failed, compiling without format:\n{msg}\n")
+    except Exception as e:
+        sys.stderr.write(f"[tikz2svg] format dump failed, compiling without format: {e}\n")
+    finally:
+        if owned:
+            release_entry(fmt_path)
+    return None
+
+
+def precompiled_format(head: str, formats_dir: str, scratch=None):
+    with _formats_lock:
+        if (head, formats_dir) not in _formats:
+            _formats[head, formats_dir] = _build_format(head, formats_dir, scratch)
+        return _formats[head, formats_dir]
+
+
+# -----------------------------------------------------------------------------
+# Build report and trace
+# - timed_stage / record_span: record a span (stage, keys, start, end, thread
+#   id) around a block or from a given start. Keys are the store entries (or,
+#   before they are known, the media paths) of the pictures the span works
+#   for; a span shared by several pictures (one lualatex run for many pages)
+#   is split evenly between them. Stages of a picture: "extract" (finding the
+#   picture in its element), "queue" (waiting for a worker), "tex-write",
+#   "lualatex", "pdftocairo", "move" (out of the temporary directory),
+#   "recolor" and "publish" (linking into MEDIA_PATH). "format" (format
+#   dumps) and "walk" (AST walks) belong to no picture.
+# - record_picture: remember a picture of this run with its keys, its cache
+#   status ("hit": every output came from the store, "miss": this run
+#   compiled some of it, "waited": another process sharing the cache compiled
+#   it meanwhile, "failed": a placeholder was published) and the bytes it
+#   published.
+# - build_report: stage totals and per-picture timings, slowest first; the
+#   queue wait is reported but not counted in a picture's seconds.
+# - write_report: with the report option, write build_report as JSON and
+#   summarize the `report-top` slowest pictures on stderr, with their label
+#   and location (section and picture number; pandoc's AST carries no line
+#   numbers).
+# - write_trace: with the trace option, write every span as a Chrome Trace
+#   Event ("X" event per span, one track per thread), named after the
+#   picture's label or code hash, for chrome://tracing or Perfetto.
+# - write_metrics: with the metrics option, write the run's numbers as gauges
+#   (pictures, cache hits/misses, failures, bytes written; the file is
+#   replaced every run, so counters would reset each build) and histograms
+#   of the lualatex and pdftocairo spans (per run; per page for daemon
+#   workers) as a Prometheus textfile, e.g. for node_exporter's textfile
+#   collector. One series per `document`.
+# - reset_report: forget the spans and pictures of the previous document.
+# -----------------------------------------------------------------------------
+WAIT_STAGES = ("queue",)
+LUALATEX_BUCKETS = (0.25, 0.5, 1, 2, 5, 10, 30, 60, 120)
+PDFTOCAIRO_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+_spans = []  # (stage, keys, start, end, thread id), appended by workers
+_pictures = []  # (job, cache status, keys, published bytes)
+_run_start = time.monotonic()
+
+
+def record_span(stage: str, start: float, keys=()):
+    _spans.append((stage, tuple(keys), start, time.monotonic(), threading.get_ident()))
+
+
+@contextlib.contextmanager
+def timed_stage(stage: str, keys=()):
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        record_span(stage, start, keys)
+
+
+def record_picture(job, status: str, keys, size: int):
+    _pictures.append((job, status, tuple(keys) + (job.black_svg,), size))
+
+
+def reset_report():
+    global _run_start
+    _spans.clear()
+    _pictures.clear()
+    _run_start = time.monotonic()
+
+
+def _picture_name(job) -> str:
+    return job.label or job.figure or sha1_hash(job.code)[:12]
+
+
+def build_report(options):
+    totals = collections.Counter()
+    per_key = collections.defaultdict(collections.Counter)
+    for stage, keys, start, end, _ in _spans:
+        totals[stage] += end - start
+        for key in keys:
+            per_key[key][stage] += (end - start) / len(keys)
+
+    pictures = []
+    for job, status, keys, size in _pictures:
+        stages = collections.Counter()
+        for key in keys:
+            stages.update(per_key.get(key, {}))
+        pictures.append({
+            "media": job.black_svg[:-len("_black.svg")],
+            "label": job.label or job.figure,
+            "location": job.location,
+            "cache": status,
+            "seconds": round(sum(s for stage, s in stages.items() if stage not in WAIT_STAGES), 4),
+            "stages": {stage: round(seconds, 4) for stage, seconds in stages.items()},
+            "bytes": size,
+        })
+    pictures.sort(key=lambda picture: picture["seconds"], reverse=True)
+    status = collections.Counter(picture["cache"] for picture in pictures)
+    return {
+        "filter_version": FILTER_VERSION,
+        "engine": options.engine,
+        "jobs": options.jobs,
+        "wall_seconds": round(time.monotonic() - _run_start, 4),
+        "stages": {stage: round(seconds, 4) for stage, seconds in totals.items()},
+        "cache": {"hits": status["hit"], "misses": status["miss"], "waited": status["waited"],
+                  "failed": status["failed"]},
+        "bytes": sum(picture["bytes"] for picture in pictures),
+        "pictures": pictures,
+    }
+
+
+def _write_output(path: str, text: str, what: str):
+    path = os.path.expanduser(str(path))
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp, path)
+    except OSError as e:
+        sys.stderr.write(f"[tikz2svg] cannot write {what}: {e}\n")
+
 
+def _stage_list(stages) -> str:
+    return ", ".join(f"{stage} {seconds:.2f} s" for stage, seconds in stages.items() if seconds >= 0.005)
+
+
+def write_report(options):
+    report = build_report(options)
+    _write_output(options.report, json.dumps(report, indent=1, ensure_ascii=False), "build report")
+
+    cache = report["cache"]
+    sys.stderr.write(f"[tikz2svg] {len(report['pictures'])} pictures ({cache['hits']} cached, "
+                     f"{cache['misses']} compiled, {cache['waited']} waited for, {cache['failed']} failed) in "
+                     f"{report['wall_seconds']:.2f} s; {_stage_list(report['stages']) or 'nothing compiled'}\n")
+    slowest = [picture for picture in report["pictures"] if picture["cache"] in ("miss", "failed")]
+    slowest = slowest[:options.report_top]
+    if slowest:
+        sys.stderr.write("[tikz2svg] slowest pictures:\n")
+    for picture in slowest:
+        name = picture["label"] or os.path.basename(picture["media"])
+        sys.stderr.write(f"  {picture['seconds']:7.2f} s  {name}  {picture['location']}  "
+                         f"({_stage_list(picture['stages'])})\n")
+
+
+def write_trace(options):
+    names = {}
+    for job, _, keys, _ in _pictures:
+        names.update(dict.fromkeys(keys, _picture_name(job)))
+
+    pid, threads, events = os.getpid(), {}, []
+    for stage, keys, start, end, thread in sorted(_spans, key=lambda span: span[2]):
+        tid = threads.setdefault(thread, len(threads) + 1)
+        pictures = list(dict.fromkeys(names.get(key, os.path.basename(key)) for key in keys))
+        name = stage if not pictures else f"{stage} {pictures[0]}" if len(pictures) == 1 \
+            else f"{stage} ({len(pictures)} pictures)"
+        events.append({"name": name, "cat": stage, "ph": "X", "pid": pid, "tid": tid,
+                       "ts": round((start - _run_start) * 1e6), "dur": round((end - start) * 1e6),
+                       "args": {"pictures": pictures} if pictures else {}})
+    main = threading.main_thread().ident
+    events.extend({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid,
+                   "args": {"name": "main" if thread == main else f"worker {tid}"}}
+                  for thread, tid in threads.items())
+    events.append({"name": "process_name", "ph": "M", "pid": pid, "tid": 0,
+                   "args": {"name": f"tikz2svg {options.document}"}})
+    _write_output(options.trace, json.dumps({"traceEvents": events, "displayTimeUnit": "ms"}), "trace")
+
+
+def _histogram(lines, name, help_text, buckets, values, labels):
+    lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+    for bound in buckets:
+        count = sum(1 for value in values if value <= bound)
+        lines.append(f'{name}_bucket{{{labels},le="{bound:g}"}} {count}')
+    lines += [f'{name}_bucket{{{labels},le="+Inf"}} {len(values)}',
+              f"{name}_sum{{{labels}}} {sum(values):.6f}", f"{name}_count{{{labels}}} {len(values)}"]
+
+
+def write_metrics(options):
+    report = build_report(options)
+    labels = f'document="{options.document}"'
+    lines = []
+    for name, help_text, value in (
+        ("pictures", "Pictures seen in the document.", len(report["pictures"])),
+        ("cache_hits", "Pictures whose SVGs all came from the store.", report["cache"]["hits"]),
+        ("cache_misses", "Pictures compiled by the run.", report["cache"]["misses"]),
+        ("cache_waited", "Pictures another process sharing the cache compiled.", report["cache"]["waited"]),
+        ("compile_failures", "Pictures whose compile failed.", report["cache"]["failed"]),
+        ("media_bytes_written", f"Bytes of SVGs written or linked into {MEDIA_PATH}.", report["bytes"]),
+        ("build_seconds", "Wall time of the run.", report["wall_seconds"]),
+        ("last_build_timestamp_seconds", "End of the run.", f"{time.time():.0f}"),
+    ):
+        lines += [f"# HELP tikz2svg_{name} {help_text} Last run only.", f"# TYPE tikz2svg_{name} gauge",
+                  f"tikz2svg_{name}{{{labels}}} {value}"]
+    for stage, buckets, help_text in (
+        ("lualatex", LUALATEX_BUCKETS, "Duration of the lualatex runs (daemon engine: of each page typeset "
+                                       "and of the end of each worker's run) of the last run."),
+        ("pdftocairo", PDFTOCAIRO_BUCKETS, "Duration of the pdftocairo runs of the last run."),
+    ):
+        _histogram(lines, f"tikz2svg_{stage}_seconds", help_text,
+                   buckets, [end - start for name, _, start, end, _ in _spans if name == stage], labels)
+    _write_output(options.metrics, "\n".join(lines) + "\n", "metrics")
+
+
+# -----------------------------------------------------------------------------
+# Scratch directories
+# - lualatex, pdftocairo and the daemon workers run in a private directory
+#   under the scratch root: the scratch-dir option, else /dev/shm when it is a
+#   writable directory (tmpfs on Linux), else the system temporary directory.
+#   Keeping aux/log/PDF churn off network-mounted build volumes matters more
+#   than the copy of the finished SVG into the store (move_file).
+# - acquire_scratch / release_scratch: check out a directory under a root and
+#   return it. Released directories are emptied and pooled instead of removed,
+#   so a run creates one directory per concurrent worker and reuses it for
+#   every job; a directory that cannot be emptied is dropped. scratch_dir is
+#   the context-manager form.
+# - remove_scratch: delete every pooled directory at exit; main() also calls
+#   it on SIGTERM (_terminate), as atexit handlers do not run then.
+# - Directories are named tikz_<host>_<pid>_..., so a run can remove those
+#   left behind on its host by a killed run (a SIGKILL, an OOM kill) the first
+#   time it uses a root (_sweep_scratch); on /dev/shm they would otherwise
+#   hold memory until the next reboot.
+# -----------------------------------------------------------------------------
+SHM_PATH = "/dev/shm"
+_scratch_lock = threading.Lock()
+_scratch_pool = collections.defaultdict(list)  # root -> emptied directories
+_scratch_dirs = []  # every directory created, removed at exit
+_scratch_swept = set()  # roots already checked for directories of dead runs
+_SCRATCH_HOST = re.sub(r"[^A-Za-z0-9.-]", "-", socket.gethostname())
+_SCRATCH_RE = re.compile(r"tikz_(?P<host>[A-Za-z0-9.-]+)_(?P<pid>\d+)_")
+
+
+def default_scratch_root():
+    return SHM_PATH if os.path.isdir(SHM_PATH) and os.access(SHM_PATH, os.W_OK) else None
+
+
+def _sweep_scratch(root):
+    try:
+        entries = list(os.scandir(root or tempfile.gettempdir()))
+    except OSError:
+        return
+    for entry in entries:
+        match = _SCRATCH_RE.match(entry.name)
+        if match is None or match["host"] != _SCRATCH_HOST or int(match["pid"]) == os.getpid():
+            continue
+        try:
+            os.kill(int(match["pid"]), 0)
+        except ProcessLookupError:
+            shutil.rmtree(entry.path, ignore_errors=True)
+        except OSError:
+            pass
+
+
+def acquire_scratch(root=None) -> str:
+    with _scratch_lock:
+        if _scratch_pool[root]:
+            return _scratch_pool[root].pop()
+        sweep = os.name == "posix" and root not in _scratch_swept
+        _scratch_swept.add(root)
+    if sweep:
+        _sweep_scratch(root)
+    path = tempfile.mkdtemp(prefix=f"tikz_{_SCRATCH_HOST}_{os.getpid()}_", dir=root)
+    with _scratch_lock:
+        _scratch_dirs.append(path)
+    return path
+
+
+def release_scratch(path: str, root=None):
+    try:
+        for entry in os.scandir(path):
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path)
+            else:
+                os.remove(entry.path)
+    except OSError:
+        shutil.rmtree(path, ignore_errors=True)
+        return
+    with _scratch_lock:
+        _scratch_pool[root].append(path)
+
+
+@contextlib.contextmanager
+def scratch_dir(root=None):
+    path = acquire_scratch(root)
+    try:
+        yield path
+    finally:
+        release_scratch(path, root)
+
+
+@atexit.register
+def remove_scratch():
+    with _scratch_lock:
+        paths = list(_scratch_dirs)
+        _scratch_dirs.clear()
+        _scratch_pool.clear()
+    for path in paths:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def _terminate(signum, frame):
+    # the handler may interrupt a holder of _scratch_lock, so no locking here
+    for path in list(_scratch_dirs):
+        shutil.rmtree(path, ignore_errors=True)
+    signal.signal(signum, signal.SIG_DFL)
+    os.kill(os.getpid(), signum)
+
+
+# -----------------------------------------------------------------------------
+# Compilation helpers
+# - _compile_document: write a LaTeX document to a scratch directory, run
+#   lualatex to produce a PDF, then call pdftocairo once per page to produce
+#   the SVGs. Moves final SVGs to their targets. Given a formats_dir the head
+#   is replaced by `-fmt` pointing at its precompiled format.
+# - compile_tikz_to_svg: single picture, single style (one lualatex run).
+# - compile_tikz_pages: several (code, style, out_svg) pages from one lualatex
+#   run; pdftocairo extracts each page with -f/-l.
+# - compile_pages_batch: compile_tikz_pages over many pictures; if the run
+#   fails, the pages are bisected so a single broken picture only costs
+#   O(log n) extra runs and its error is reported on its own.
+# - Behavior: capture the tools' output to avoid polluting Pandoc; emit a
+#   trimmed message to sys.stderr on errors (keeps Pandoc JSON clean).
+#   report_error also remembers the message for the failed store entries so
+#   compile_jobs can record the failure (see "Failed compiles"), but only for
+#   a real TeX error: lualatex ended the run itself with a `!` error line.
+#   Timeouts, killed workers, pipe errors and pdftocairo failures are only
+#   reported, so the next run compiles the picture again.
+# -----------------------------------------------------------------------------
+_compile_errors = {}  # store_svg -> truncated error of its failed compile
+
+
+def tex_error_line(error: str):
+    return next((line.strip() for line in error.splitlines() if line.strip().startswith("!")), None)
+
+
+def report_error(out_svgs, msg: str, record: bool = True):
+    sys.stderr.write(f"[tikz2svg] compile error:\n{msg}\n")
+    if record and tex_error_line(msg) is not None:
+        for out_svg in out_svgs:
+            _compile_errors[out_svg] = msg
+
+
+def _lualatex_command(fmt):
+    cmd = ["lualatex", "-halt-on-error", "-interaction=nonstopmode"]
+    env = None
+    if fmt:
+        fmt_dir, fmt_name = os.path.split(os.path.splitext(fmt)[0])
+        cmd.append(f"-fmt={fmt_name}")
+        # trailing separator keeps the default search path
+        env = dict(os.environ, TEXFORMATS=fmt_dir + os.pathsep + os.environ.get("TEXFORMATS", ""))
+    return cmd, env
+
+
+def _split_pdf(pdf_path: str, tmp: str, out_svgs):
+    for page, out_svg in enumerate(out_svgs, start=1):
+        svg_path = os.path.join(tmp, f"t{page}.svg")
+        cmd = ["pdftocairo", "-svg"]
+        if len(out_svgs) > 1:
+            cmd += ["-f", str(page), "-l", str(page)]
+        with timed_stage("pdftocairo", [out_svg]):
             subprocess.run(
-                ["pdftocairo", "-svg", pdf_path, svg_path],
+                cmd + [pdf_path, svg_path],
                 check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
             )
+        with timed_stage("move", [out_svg]):
+            move_file(svg_path, out_svg)
 
-            os.replace(svg_path, out_svg)
+
+def _compile_document(head: str, body: str, out_svgs, formats_dir=None,
+                      report: bool = True, scratch=None) -> bool:
+    fmt = precompiled_format(head, formats_dir, scratch) if formats_dir else None
+    cmd, env = _lualatex_command(fmt)
+
+    try:
+        with scratch_dir(scratch) as tmp:
+            tex_path = os.path.join(tmp, "t.tex")
+            pdf_path = os.path.join(tmp, "t.pdf")
+            with timed_stage("tex-write", out_svgs), open(tex_path, "w", encoding="utf-8") as f:
+                # mylatexformat skips a document's preamble up to \endofdump;
+                # mark the start so the style line in the body is executed
+                f.write(FORMAT_BODY_PREFIX + body if fmt else head + body)
+
+            # lualatex reports TeX errors on stdout
+            with timed_stage("lualatex", out_svgs):
+                subprocess.run(
+                    cmd + ["-output-directory", tmp, tex_path],
+                    check=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env
+                )
+
+            _split_pdf(pdf_path, tmp, out_svgs)
         return True
 
     except subprocess.CalledProcessError as e:
         # On compile error show a truncated error to stderr (keeps pandoc output clean)
-        msg = e.stderr.decode("utf-8", errors="ignore")[-400:]
-        sys.stderr.write(f"[tikz2svg] compile error:\n{msg}\n")
+        if report:
+            report_error(out_svgs, (e.output or e.stderr or b"").decode("utf-8", errors="ignore")[-400:],
+                         record=e.cmd[0] == "lualatex")
         return False
     except Exception as e:
-        sys.stderr.write(f"[tikz2svg] unexpected error: {e}\n")
+        if report:
+            sys.stderr.write(f"[tikz2svg] unexpected error: {e}\n")
         return False
 
 
+def compile_tikz_to_svg(code: str, out_svg: str, style: str, formats_dir=None, scratch=None) -> bool:
+    return _compile_document(DOC_HEAD, DOC_BODY % (style, code), [out_svg], formats_dir, scratch=scratch)
+
+
+def compile_tikz_pages(pages, formats_dir=None, report: bool = True, scratch=None) -> bool:
+    body = "".join(PAGE_TEMPLATE % (style, code) for code, style, _ in pages)
+    return _compile_document(PAGES_HEAD, PAGES_BODY % body,
+                             [out_svg for _, _, out_svg in pages], formats_dir, report, scratch)
+
+
+def compile_pages_batch(pages, formats_dir=None, scratch=None) -> bool:
+    if not pages:
+        return True
+    if compile_tikz_pages(pages, formats_dir, report=len(pages) == 1, scratch=scratch):
+        return True
+    if len(pages) == 1:
+        return False
+    # one bad picture fails the whole run: bisect until it is isolated
+    mid = len(pages) // 2
+    left = compile_pages_batch(pages[:mid], formats_dir, scratch)
+    right = compile_pages_batch(pages[mid:], formats_dir, scratch)
+    return left and right
+
+
+# -----------------------------------------------------------------------------
+# Persistent TeX workers ("daemon" engine)
+# - TexWorker: a lualatex process that has loaded PAGES_HEAD (or its
+#   precompiled format) and then reads pictures from stdin through a small Lua
+#   loop (DAEMON_LUA), shipping out one page per picture and acknowledging
+#   each page on stdout. The PDF is only complete once the run ends, so a
+#   worker is retired after `daemon_pages` pictures (or when the queue runs
+#   dry) and its PDF is split with pdftocairo -f/-l. The replacement worker is
+#   started first so it loads the preamble while the old PDF is split.
+# - _daemon_slot: one pool slot driving a worker over the shared page queue.
+#   A worker that crashes or does not answer within `timeout` seconds is
+#   killed and its acknowledged pages (lost with its PDF) are requeued. The
+#   failing picture is requeued as suspect, to be retried as the first picture
+#   of a fresh worker; if it fails there, the picture itself is broken and its
+#   error is reported.
+# - _retire: end a worker's run and split its PDF. If the run fails at the
+#   end (TeX error, timeout, pdftocairo), its pages are requeued as suspects,
+#   each to be retried alone on a fresh worker; a worker that typeset a
+#   single page reports its error instead.
+# - compile_pages_daemon: run `jobs` slots until the queue is empty.
+# -----------------------------------------------------------------------------
+DAEMON_LUA = r"""
+local function next_page()
+  local header = io.read("*l")
+  local size = header and tonumber(header:match("^PAGE (%d+)$"))
+  if not size then
+    tex.print("\\end{document}")
+    return
+  end
+  local lines = {}
+  for line in (io.read(size) .. "\n"):gmatch("(.-)\r?\n") do
+    lines[#lines + 1] = line
+  end
+  lines[#lines + 1] = "\\directlua{tikz2svg_done()}"
+  tex.print(lines)
+end
+
+function tikz2svg_done()
+  io.stdout:write("\nTIKZ2SVG-DONE\n")
+  io.stdout:flush()
+  next_page()
+end
+
+next_page()
+"""
+
+DAEMON_BODY = r"""
+\begin{document}
+\directlua{dofile("tikz2svg-worker.lua")}
+"""
+
+
+class TexWorker:
+    def __init__(self, formats_dir=None, scratch=None):
+        self.scratch = scratch
+        self.dir = acquire_scratch(scratch)
+        self.pages = []  # acknowledged (code, style, out_svg), in page order
+        self.log = collections.deque(maxlen=40)
+        self.timed_out = False
+        self.lines = queue.Queue()
+
+        fmt = precompiled_format(PAGES_HEAD, formats_dir, scratch) if formats_dir else None
+        cmd, env = _lualatex_command(fmt)
+        with open(os.path.join(self.dir, "tikz2svg-worker.lua"), "w", encoding="utf-8") as f:
+            f.write(DAEMON_LUA)
+        with open(os.path.join(self.dir, "w.tex"), "w", encoding="utf-8") as f:
+            f.write((FORMAT_BODY_PREFIX if fmt else PAGES_HEAD) + DAEMON_BODY)
+        try:
+            self.proc = subprocess.Popen(
+                cmd + ["w.tex"], cwd=self.dir, env=env,
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+            )
+        except OSError:
+            release_scratch(self.dir, scratch)
+            raise
+        threading.Thread(target=self._read, daemon=True).start()
+
+    def _read(self):
+        for line in self.proc.stdout:
+            self.lines.put(line.decode("utf-8", errors="ignore").rstrip())
+        self.lines.put(None)
+
+    def error(self) -> str:
+        return "\n".join(self.log)[-400:]
+
+    def stopped_by_tex(self) -> bool:
+        # a TeX error ends the run by itself; a hang or a broken pipe does not
+        if self.timed_out:
+            return False
+        try:
+            return self.proc.wait(1) != 0 and tex_error_line(self.error()) is not None
+        except subprocess.TimeoutExpired:
+            return False
+
+    def typeset(self, page, timeout: float) -> bool:
+        with timed_stage("lualatex", [page[2]]):
+            return self._typeset(page, timeout)
+
+    def _typeset(self, page, timeout: float) -> bool:
+        code, style, _ = page
+        data = (PAGE_TEMPLATE % (style, code)).encode("utf-8")
+        try:
+            self.proc.stdin.write(b"PAGE %d\n" % len(data) + data)
+            self.proc.stdin.flush()
+        except OSError:
+            return False
+
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                line = self.lines.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                self.log.append(f"no answer within {timeout:g} s")
+                self.timed_out = True
+                return False
+            if line is None:
+                return False
+            if line.strip() == "TIKZ2SVG-DONE":
+                self.pages.append(page)
+                return True
+            self.log.append(line)
+
+    def finish(self, timeout: float) -> bool:
+        # on failure the reason is in error() and no page of self.pages is done
+        try:
+            with timed_stage("lualatex", [out_svg for _, _, out_svg in self.pages]):
+                try:
+                    self.proc.stdin.write(b"END\n")
+                    self.proc.stdin.close()
+                except OSError:
+                    pass  # already gone, the exit status tells why
+                self.proc.wait(timeout)
+            self._drain()
+            if self.proc.returncode != 0:
+                return False
+            if self.pages:
+                _split_pdf(os.path.join(self.dir, "w.pdf"), self.dir,
+                           [out_svg for _, _, out_svg in self.pages])
+            return True
+        except subprocess.TimeoutExpired:
+            self.log.append(f"run did not end within {timeout:g} s")
+            self.timed_out = True
+            return False
+        except subprocess.CalledProcessError as e:
+            self.log.append(e.stderr.decode("utf-8", errors="ignore")[-400:])
+            return False
+        except Exception as e:
+            self.log.append(f"unexpected error: {e}")
+            return False
+        finally:
+            self.kill()
+
+    def _drain(self):
+        # output of the run after the last acknowledged page, e.g. its error
+        try:
+            while True:
+                line = self.lines.get(timeout=1)
+                if line is None:
+                    return
+                self.log.append(line)
+        except queue.Empty:
+            pass
+
+    def kill(self):
+        if self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.wait()
+        if self.dir is not None:
+            release_scratch(self.dir, self.scratch)
+            self.dir = None
+
+
+def _retire(worker, pages, options):
+    if worker.finish(options.timeout):
+        return
+    lost = [done for done in worker.pages if not os.path.exists(done[2])]
+    if len(worker.pages) == 1:
+        report_error([done[2] for done in lost], worker.error(), record=worker.stopped_by_tex())
+        return
+    for done in lost:
+        pages.put((done, True, time.monotonic()))
+
+
+def _daemon_slot(pages, options):
+    worker = None
+    while True:
+        try:
+            page, suspect, queued = pages.get_nowait()
+        except queue.Empty:
+            break
+        record_span("queue", queued, [page[2]])
+
+        try:
+            if worker is not None and (suspect or len(worker.pages) >= options.daemon_pages):
+                retired, worker = worker, TexWorker(formats_dir(options), options.scratch_dir)
+                _retire(retired, pages, options)
+            if worker is None:
+                worker = TexWorker(formats_dir(options), options.scratch_dir)
+        except OSError as e:
+            sys.stderr.write(f"[tikz2svg] cannot start lualatex: {e}\n")
+            continue
+
+        if worker.typeset(page, options.timeout):
+            continue
+
+        # crashed or hung: recycle the worker, its acknowledged pages are lost
+        tex_failed = worker.stopped_by_tex()
+        worker.kill()
+        for done in worker.pages:
+            pages.put((done, False, time.monotonic()))
+        if worker.pages:
+            pages.put((page, True, time.monotonic()))
+        else:
+            report_error([page[2]], worker.error(), record=tex_failed)
+        worker = None
+
+    if worker is not None:
+        _retire(worker, pages, options)
+
+
+def compile_pages_daemon(pages, options):
+    todo = queue.Queue()
+    for page in pages:
+        todo.put((page, False, time.monotonic()))
+    while not todo.empty():
+        slots = min(options.jobs, todo.qsize())
+        _run_tasks([functools.partial(_daemon_slot, todo, options)] * slots, slots)
+
+
+# -----------------------------------------------------------------------------
+# SVG recoloring
+# - STYLE_WHITE only swaps the default draw/text colour, so the white variant
+#   can be derived from the black SVG instead of running lualatex again.
+# - has_explicit_colors: conservative check of the TikZ source for colours set
+#   by the author (\color, fill=..., bare colour options); such pictures keep
+#   their colours under STYLE_WHITE and cannot be mapped blindly.
+# - map_svg_colors: rewrite every black fill/stroke in pdftocairo output
+#   (attributes and style properties, rgb(0%,0%,0%) / #000 / black forms) to
+#   `color`. The SVG initial fill is black, so glyph <use> elements without a
+#   fill of their own are covered by setting the same fill on the root <svg>.
+#   Returns None if the SVG contains any other colour (unless strict=False,
+#   which leaves other colours alone).
+# - recolor_svg_file: apply map_svg_colors to a file and publish atomically.
+# - inline_svg: prepare an SVG for embedding in Markdown: drop the XML prolog
+#   and blank lines (which would end the raw HTML block) and prefix all ids,
+#   since pdftocairo names glyphs identically in every file.
+# -----------------------------------------------------------------------------
+WHITE = "rgb(100%,100%,100%)"
+CURRENT_COLOR = "currentColor"
+
+_EXPLICIT_COLOR_RE = re.compile(
+    r"\\(?:color|textcolor|colorbox|fcolorbox|pagecolor|definecolor|colorlet)\b"
+    r"|\b(?:color|fill|draw|text|shade|ball color|top color|bottom color|left color"
+    r"|right color|inner color|outer color)\s*=\s*(?!none\b)[^\s,\]]"
+    r"|\b(?:black|white|red|green|blue|cyan|magenta|yellow|gray|grey|darkgray"
+    r"|lightgray|brown|lime|olive|orange|pink|purple|teal|violet)\b"
+)
+
+_SVG_COLOR_RE = re.compile(
+    r'(?P<prop>\b(?:fill|stroke|stop-color|flood-color|lighting-color|color)'
+    r'(?:="|\s*:\s*))(?P<value>[^";]+)'
+)
+
+_SVG_BLACK = {"rgb(0%,0%,0%)", "rgb(0,0,0)", "#000", "#000000", "black"}
+_SVG_WHITE = {"rgb(100%,100%,100%)", "rgb(255,255,255)", "#fff", "#ffffff", "white"}
+_SVG_NEUTRAL = {"none", "currentcolor", "inherit", "transparent"}
+
+
+def has_explicit_colors(code: str) -> bool:
+    return _EXPLICIT_COLOR_RE.search(code) is not None
+
+
+def map_svg_colors(svg: str, color: str, strict: bool = True):
+    unsafe = False
+
+    def repl(m):
+        nonlocal unsafe
+        value = re.sub(r"\s+", "", m.group("value")).lower()
+        if value in _SVG_BLACK:
+            return m.group("prop") + color
+        if strict and not (value in _SVG_WHITE or value in _SVG_NEUTRAL or value.startswith("url(")):
+            unsafe = True
+        return m.group(0)
+
+    mapped = _SVG_COLOR_RE.sub(repl, svg)
+    if unsafe:
+        return None
+    root = re.search(r"<svg\b[^>]*>", mapped)
+    if root and not re.search(r'\sfill="', root.group(0)):
+        mapped = mapped[:root.start() + 4] + f' fill="{color}"' + mapped[root.start() + 4:]
+    return mapped
+
+
+def recolor_svg_file(src_svg: str, out_svg: str, color: str, strict: bool = True) -> bool:
+    try:
+        with timed_stage("recolor", [out_svg]):
+            with open(src_svg, encoding="utf-8") as f:
+                mapped = map_svg_colors(f.read(), color, strict)
+            if mapped is None:
+                return False
+            tmp_svg = f"{out_svg}.{os.getpid()}.tmp"
+            with open(tmp_svg, "w", encoding="utf-8") as f:
+                f.write(mapped)
+            os.replace(tmp_svg, out_svg)
+            return True
+    except OSError as e:
+        sys.stderr.write(f"[tikz2svg] recolor error: {e}\n")
+        return False
+
+
+def inline_svg(svg: str, prefix: str) -> str:
+    svg = re.sub(r"<\?xml[^>]*\?>|<!DOCTYPE[^>]*>", "", svg)
+    ids = set(re.findall(r'\bid="([^"]+)"', svg))
+
+    def scope(m):
+        return m.group(1) + prefix + m.group(2) if m.group(2) in ids else m.group(0)
+
+    svg = re.sub(r'(\bid="|href="#|url\(#)([^")]+)', scope, svg)
+    return "\n".join(line for line in svg.splitlines() if line.strip())
+
+
 # -----------------------------------------------------------------------------
 # Helper to detect previously emitted dark/light raw blocks
 # - _is_tikz_darklight_raw: checks RawBlock text for the class markers used in
@@ -141,74 +1334,100 @@ def _is_tikz_darklight_raw(block):
 
 
 # -----------------------------------------------------------------------------
-# Main filter action
-# - tikz_filter: invoked for each AST element. Responsibilities:
-#     * track Header elements to build numbering state for filenames
-#     * process pf.Figure nodes containing Raw LaTeX TikZ blocks:
-#         - extract tikz, generate images, emit MyST FOUR-colon figure directive
-#     * process pf.Div with class "center" containing TikZ:
-#         - extract tikz, generate images, emit two MyST ::: {div} blocks
-#     * leave other elements unchanged
-# - The function tries to be defensive: if extraction fails, it returns the
-#   original element (or None where appropriate) to avoid breaking the AST.
+# Job collection
+# - TikzJob: one picture to render, with its black/white output paths and
+#   the single currentColor SVG used by the "adaptive" output, plus the
+#   subfigure caption/label written next to it in the LaTeX source, the
+#   identifier of its figure and its location for the build report.
+# - _job_outputs: the media files the configured output references.
+# - _track_header: maintain doc.level1_number, doc.level2_number and the
+#   per-section image counters used for filenames, and doc.section_title.
+# - _find_tikz: return the pictures of a pf.Figure or pf.Div.center as
+#   (code, caption, label), from every RawBlock containing one, or an empty
+#   list if the element is not a candidate. A LaTeX RawBlock or RawInline
+#   anywhere else (bare, in a minipage or table cell, inline in a paragraph)
+#   is a candidate of its own; inside a figure or centered div it is left to
+#   that element.
+# - _make_jobs: number the pictures and build their TikzJobs; each picture is
+#   an independent job, numbered as if it had its own element.
+# - collect_tikz: first walk; records the TikzJobs of each element in
+#   doc.tikz_jobs (keyed by id(elem)) without touching the AST.
 # -----------------------------------------------------------------------------
-def tikz_filter(elem, doc):
+@dataclass
+class TikzJob:
+    code: str
+    black_svg: str
+    white_svg: str
+    adaptive_svg: str
+    caption: str = ""
+    label: str = ""
+    figure: str = ""
+    location: str = ""
 
-    # --- 1) Track header numbering for image filenames ---
-    # Create and maintain doc.level1_number, doc.level2_number and image counters.
-    if isinstance(elem, pf.Header):
-        if not hasattr(doc, "level1_number"):
-            doc.level1_number = []
-            doc.level2_number = []
-            doc.image_num_per_level2 = {}
-
-        if elem.level == 1:
-            # increment or init chapter counter
-            if not doc.level1_number:
-                doc.level1_number = [1]
-            else:
-                doc.level1_number[-1] += 1
-            doc.level2_number = []
-            doc.image_num_per_level2 = {}
-
-        elif elem.level == 2:
-            # increment or init section counter
-            if not doc.level2_number:
-                doc.level2_number = [1]
-            else:
-                doc.level2_number[-1] += 1
-            # initialize per-section image counter map
-            doc.image_num_per_level2[tuple(doc.level2_number)] = 0
 
-        return elem
+def _job_outputs(job, options):
+    return (job.adaptive_svg,) if options.output == "adaptive" else (job.black_svg, job.white_svg)
+
+
+def _ensure_numbering(doc):
+    if not hasattr(doc, "level1_number"):
+        doc.level1_number = []
+        doc.level2_number = []
+        doc.image_num_per_level2 = {}
+        doc.section_title = ""
+
+
+def _track_header(elem, doc):
+    _ensure_numbering(doc)
+    if elem.level <= 2:
+        doc.section_title = pf.stringify(elem)
+
+    if elem.level == 1:
+        # increment or init chapter counter
+        if not doc.level1_number:
+            doc.level1_number = [1]
+        else:
+            doc.level1_number[-1] += 1
+        doc.level2_number = []
+        doc.image_num_per_level2 = {}
 
-    # --- 2) Handle Figure nodes (LaTeX \begin{figure}) ---
-    # Look for pf.Figure objects created by Pandoc from LaTeX figure environments.
-    # If a RawBlock child contains tikz, extract, compile and replace with MyST.
-    if isinstance(elem, pf.Figure):
-        label = elem.identifier or ""
-        # use pf.stringify for caption (keeps existing behavior)
-        caption = pf.stringify(elem.caption) if elem.caption else ""
+    elif elem.level == 2:
+        # increment or init section counter
+        if not doc.level2_number:
+            doc.level2_number = [1]
+        else:
+            doc.level2_number[-1] += 1
+        # initialize per-section image counter map
+        doc.image_num_per_level2[tuple(doc.level2_number)] = 0
 
-        # find tikz/circuitikz content inside figure
-        tikz_raw = None
+
+RAW_FORMATS = ("latex", "tex")
+
+
+def _is_container(elem):
+    return isinstance(elem, pf.Figure) or (isinstance(elem, pf.Div) and "center" in elem.classes)
+
+
+def _find_tikz(elem):
+    pictures = []
+    if isinstance(elem, (pf.RawBlock, pf.RawInline)):
+        if elem.format in RAW_FORMATS and not _is_container(elem.parent):
+            pictures = [(code, "", "") for _, _, code in scan_tikz(elem.text)]
+    elif _is_container(elem):
         for c in elem.content:
-            if isinstance(c, pf.RawBlock) and any(k in c.text for k in ("tikzpicture","circuitikz","begin{picture}")):
-                tikz_raw = c.text
-                break
-        if not tikz_raw:
-            return elem
-
-        tikz_code = extract_tikz(tikz_raw)
-        if not tikz_code:
-            return elem
-
-        # ensure numbering state exists
-        if not hasattr(doc, "level1_number"):
-            doc.level1_number = []
-            doc.level2_number = []
-            doc.image_num_per_level2 = {}
+            if isinstance(c, pf.RawBlock):
+                found = scan_tikz(c.text)
+                for i, (_, end, code) in enumerate(found):
+                    segment = c.text[end:found[i + 1][0] if i + 1 < len(found) else len(c.text)]
+                    pictures.append((code,) + (subcaption(segment) if len(found) > 1 else ("", "")))
+    return pictures
+
 
+def _make_jobs(elem, doc):
+    start = time.monotonic()
+    jobs = []
+    for tikz_code, caption, label in _find_tikz(elem):
+        _ensure_numbering(doc)
         hl1 = sanitize_number(doc.level1_number)
         hl2 = sanitize_number(doc.level2_number)
         key = tuple(doc.level2_number)
@@ -219,122 +1438,1195 @@ def tikz_filter(elem, doc):
         os.makedirs(MEDIA_PATH, exist_ok=True)
         h = sha1_hash(tikz_code)
         base = f"{hl1}_{hl2}_{img_num}_{h}"
-        black_svg = os.path.join(MEDIA_PATH, f"{base}_black.svg")
-        white_svg = os.path.join(MEDIA_PATH, f"{base}_white.svg")
-
-        # Compile if not already present
-        if not os.path.exists(black_svg):
-            compile_tikz_to_svg(tikz_code, black_svg, STYLE_BLACK)
-        if not os.path.exists(white_svg):
-            compile_tikz_to_svg(tikz_code, white_svg, STYLE_WHITE)
-
-        # Use forward slashes in generated links (cross-platform)
-        black_rel = black_svg.replace("\\", "/")
-        white_rel = white_svg.replace("\\", "/")
-
-        # Build the MyST block using explicit literal strings to avoid accidental brace/newline insertion.
-        # Use :label: field (if present).
-        label_field = f":label: {label}\n" if label else ""
-
-        myst_lines = []
-        myst_lines.append("::::{figure}")              # FOUR colons outer fence
-        if label_field:
-            myst_lines.append(label_field.rstrip())
-        myst_lines.append(f":alt: {caption}")
-        myst_lines.append("")  # blank line
-        # dark image
-        myst_lines.append(":::{div}")
-        myst_lines.append(":class: dark:hidden")
-        myst_lines.append(f"![]({black_rel})")
-        myst_lines.append(":::")
-        myst_lines.append("")  # blank line between divs
-        # light image
-        myst_lines.append(":::{div}")
-        myst_lines.append(":class: hidden dark:block")
-        myst_lines.append(f"![]({white_rel})")
-        myst_lines.append(":::")
-        myst_lines.append("")  # blank line before caption
-        myst_lines.append(caption)
-        myst_lines.append("::::")  # close outer figure with FOUR colons
-
-        myst = "\n".join(myst_lines) + "\n"
-
-        # Return as markdown raw block so Pandoc doesn't escape newlines as entities
-        return [pf.RawBlock(myst, format="markdown")]
-
-    # --- 3) Handle Div.center that contain TikZ/CircuitikZ ---
-    # These are typically Pandoc Div blocks with class "center" created from LaTeX center environments.
-    # The filter extracts the tikz code, compiles images and emits two MyST div blocks as siblings
-    # so that they are not wrapped in a centering container.
-    if isinstance(elem, pf.Div) and "center" in elem.classes:
-        # look for RawBlock child with TikZ
-        for child in elem.content:
-            if isinstance(child, pf.RawBlock) and any(k in child.text for k in ("tikzpicture","circuitikz","begin{picture}")):
-                tikz_code = extract_tikz(child.text)
-                if not tikz_code:
-                    return elem
-
-                # numbering for standalone center images
-                if not hasattr(doc, "level1_number"):
-                    doc.level1_number = []
-                    doc.level2_number = []
-                    doc.image_num_per_level2 = {}
-
-                hl1 = sanitize_number(doc.level1_number)
-                hl2 = sanitize_number(doc.level2_number)
-                key = tuple(doc.level2_number)
-                doc.image_num_per_level2.setdefault(key, 0)
-                doc.image_num_per_level2[key] += 1
-                img_num = doc.image_num_per_level2[key]
-
-                os.makedirs(MEDIA_PATH, exist_ok=True)
-                h = sha1_hash(tikz_code)
-                base = f"{hl1}_{hl2}_{img_num}_{h}"
-                out_black = os.path.join(MEDIA_PATH, f"{base}_black.svg")
-                out_white = os.path.join(MEDIA_PATH, f"{base}_white.svg")
-
-                if not os.path.exists(out_black):
-                    compile_tikz_to_svg(tikz_code, out_black, STYLE_BLACK)
-                if not os.path.exists(out_white):
-                    compile_tikz_to_svg(tikz_code, out_white, STYLE_WHITE)
-
-                black_rel = out_black.replace("\\", "/")
-                white_rel = out_white.replace("\\", "/")
-
-                md_lines = []
-                md_lines.append(":::{div}")
-                md_lines.append(":class: dark:hidden")
-                md_lines.append(f"![]({black_rel})")
-                md_lines.append(":::")
-                md_lines.append("")  # blank line
-                md_lines.append(":::{div}")
-                md_lines.append(":class: hidden dark:block")
-                md_lines.append(f"![]({white_rel})")
-                md_lines.append(":::")
-                md_lines.append("")
-
-                md = "\n".join(md_lines).strip() + "\n"
-                return [pf.RawBlock(md, format="markdown")]
+        where = f"{hl1.replace('_', '.')}.{hl2.replace('_', '.')} {doc.section_title}".rstrip()
+        jobs.append(TikzJob(
+            code=tikz_code,
+            black_svg=os.path.join(MEDIA_PATH, f"{base}_black.svg"),
+            white_svg=os.path.join(MEDIA_PATH, f"{base}_white.svg"),
+            adaptive_svg=os.path.join(MEDIA_PATH, f"{base}.svg"),
+            caption=caption,
+            label=label,
+            figure=getattr(elem, "identifier", ""),
+            location=f"{where}, picture {img_num}",
+        ))
+    if jobs:
+        record_span("extract", start, [job.black_svg for job in jobs])
+    return jobs
+
+
+def collect_tikz(elem, doc):
+    if isinstance(elem, pf.Header):
+        _track_header(elem, doc)
+    elif isinstance(elem, (pf.Figure, pf.Div, pf.RawBlock, pf.RawInline)):
+        jobs = _make_jobs(elem, doc)
+        if jobs:
+            doc.tikz_jobs[id(elem)] = jobs
+
+
+# -----------------------------------------------------------------------------
+# Content-addressed store
+# - Compiled SVGs live in <cache-dir>/store under a key derived from what they
+#   are rendered from, not from where they appear in the document:
+#     * cache_fingerprint: everything except the picture that affects the
+#       output; filter version, both template heads and the lualatex and
+#       pdftocairo version strings. A changed template or TeX Live/Poppler
+#       update thus invalidates exactly the entries rendered with the old one.
+#     * cache_key: fingerprint + style + picture code
+#     * derived_key: an SVG produced from another one by a rewrite (recolor,
+#       currentColor)
+# - publish_svg: make a numbered media file point at a store entry, as a hard
+#   link when possible and a copy otherwise. Inserting or reordering sections
+#   therefore only relinks files and never recompiles, and a media file left
+#   over from an older fingerprint is replaced on the next run. A copy keeps
+#   the entry's mtime, so a later run recognizes it (same size and mtime) and
+#   leaves it alone; returns whether the media file was written.
+# -----------------------------------------------------------------------------
+def store_dir(cache_dir: str = CACHE_PATH) -> str:
+    return os.path.join(cache_dir, "store")
+
+
+def formats_dir(options):
+    return os.path.join(options.cache_dir, "formats") if options.format else None
+
+
+@functools.lru_cache(maxsize=None)
+def cache_fingerprint() -> str:
+    return sha1_hash("\0".join((
+        FILTER_VERSION,
+        DOC_HEAD,
+        PAGES_HEAD,
+        tool_version("lualatex"),
+        tool_version("pdftocairo", "-v"),
+    )))
+
+
+def cache_key(code: str, style: str) -> str:
+    return sha1_hash("\0".join((cache_fingerprint(), style, code)))
+
+
+def derived_key(key: str, transform: str) -> str:
+    return sha1_hash(f"{key}\0{transform}")
+
+
+def store_path(key: str, cache_dir: str = CACHE_PATH) -> str:
+    return os.path.join(store_dir(cache_dir), key + ".svg")
+
+
+def publish_svg(store_svg: str, out_svg: str) -> bool:
+    try:
+        out = os.stat(out_svg)
+    except FileNotFoundError:
+        pass
+    else:
+        store = os.stat(store_svg)
+        if os.path.samestat(store, out) or \
+                (out.st_size, out.st_mtime_ns) == (store.st_size, store.st_mtime_ns):
+            return False  # the link, or a copy of this entry (copy2 keeps the mtime)
+    tmp_svg = f"{out_svg}.{os.getpid()}.tmp"
+    try:
+        os.link(store_svg, tmp_svg)
+    except OSError:
+        shutil.copy2(store_svg, tmp_svg)
+    try:
+        os.replace(tmp_svg, out_svg)
+    except OSError:
+        os.remove(tmp_svg)
+        raise
+    return True
+
+
+# -----------------------------------------------------------------------------
+# Failed compiles
+# - A page that fails with a TeX error leaves a failure record next to the
+#   store entry it should have produced, <key>.fail (<key>.fmt.fail when it
+#   was compiled against the precompiled format), holding the truncated error
+#   (transient failures leave none, see report_error). The key covers the
+#   picture code and the toolchain fingerprint, so editing the picture or
+#   upgrading TeX Live compiles it again, and so does turning the format off
+#   after a preamble that does not survive the format dump; until then later
+#   runs skip it instead of paying for the failing compile once more (the
+#   retry-failed option overrides this).
+# - record_failures: after a compile, write the records of pages whose
+#   failure was attributed to them and drop those of pages that succeeded.
+# - publish_placeholder: put a stand-in SVG showing the first TeX error line
+#   at a media path whose picture failed, so the build still finishes and the
+#   rendered document shows which diagram is broken.
+# -----------------------------------------------------------------------------
+PLACEHOLDER_SVG = """<svg xmlns="http://www.w3.org/2000/svg" width="360" height="64" viewBox="0 0 360 64">
+<rect x="1" y="1" width="358" height="62" fill="none" stroke="#c33" stroke-width="2" stroke-dasharray="6 4"/>
+<text x="180" y="27" fill="#c33" font-family="sans-serif" font-size="14" text-anchor="middle">TikZ compile error</text>
+<text x="180" y="47" fill="#c33" font-family="monospace" font-size="11" text-anchor="middle">%s</text>
+</svg>
+"""
+
+
+def failure_path(store_svg: str, options) -> str:
+    return os.path.splitext(store_svg)[0] + (".fmt.fail" if options.format else ".fail")
+
+
+def needs_compile(store_svg: str, options) -> bool:
+    if os.path.exists(store_svg):
+        return False
+    return options.retry_failed or not os.path.exists(failure_path(store_svg, options))
+
+
+def record_failures(pages, options):
+    for _, _, store_svg in pages:
+        error = _compile_errors.pop(store_svg, None)
+        fail = failure_path(store_svg, options)
+        if os.path.exists(store_svg):
+            if os.path.exists(fail):
+                os.remove(fail)
+        elif error is not None:
+            tmp = f"{fail}.{os.getpid()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(error)
+            os.replace(tmp, fail)
+
+
+def _error_line(error: str) -> str:
+    lines = [line.strip() for line in error.splitlines() if line.strip()]
+    line = tex_error_line(error) or (lines[-1] if lines else "")
+    return line if len(line) <= 60 else line[:57] + "..."
+
+
+def publish_placeholder(out_svg: str, sources, options) -> bool:
+    for store_svg in sources:
+        try:
+            with open(failure_path(store_svg, options), encoding="utf-8") as f:
+                line = _error_line(f.read())
+            break
+        except OSError:
+            continue
+    else:
+        return False  # not a recorded failure, e.g. lualatex missing
+
+    tmp_svg = f"{out_svg}.{os.getpid()}.tmp"
+    with open(tmp_svg, "w", encoding="utf-8") as f:
+        f.write(PLACEHOLDER_SVG % html.escape(line))
+    os.replace(tmp_svg, out_svg)
+    sys.stderr.write(f"[tikz2svg] {out_svg}: compile failed ({line}), placeholder written\n")
+    return True
+
+
+# -----------------------------------------------------------------------------
+# Cache index
+# - CacheIndex: SQLite database <cache-dir>/index.sqlite with one row per store
+#   entry: size, creation time, last time a run used it and how long it took
+#   to compile. compile_jobs records every entry it creates or reuses.
+# - prune: evict entries older than max_age (by last use), then the least
+#   recently used ones until the store is below max_bytes. Store files the
+#   index does not know about (older caches, crashed runs) are adopted first
+#   with their mtime; entries currently claimed by a compile are never evicted.
+# -----------------------------------------------------------------------------
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL,
+    last_hit REAL NOT NULL,
+    compile_seconds REAL NOT NULL DEFAULT 0
+)
+"""
+
+
+class CacheIndex:
+    def __init__(self, cache_dir: str):
+        self.store = store_dir(cache_dir)
+        os.makedirs(self.store, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(cache_dir, "index.sqlite"), timeout=60)
+        self.db.execute(INDEX_SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def record(self, hits, created):
+        now = time.time()
+        with self.db:
+            self.db.executemany(
+                "INSERT INTO entries (key, size, created, last_hit) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET last_hit = excluded.last_hit",
+                [(os.path.basename(svg), os.path.getsize(svg), now, now) for svg in hits]
+            )
+            self.db.executemany(
+                "INSERT INTO entries (key, size, created, last_hit, compile_seconds) "
+                "VALUES (?, ?, ?, ?, ?) ON CONFLICT(key) DO UPDATE SET size = excluded.size, "
+                "created = excluded.created, last_hit = excluded.last_hit, "
+                "compile_seconds = excluded.compile_seconds",
+                [(os.path.basename(svg), os.path.getsize(svg), now, now, seconds)
+                 for svg, seconds in created.items()]
+            )
+
+    def sync(self):
+        on_disk = {}
+        for entry in os.scandir(self.store):
+            if entry.name.endswith(".svg") and entry.is_file():
+                stat = entry.stat()
+                on_disk[entry.name] = (stat.st_size, stat.st_mtime)
+        known = {key for key, in self.db.execute("SELECT key FROM entries")}
+        with self.db:
+            self.db.executemany("DELETE FROM entries WHERE key = ?",
+                                [(key,) for key in known - on_disk.keys()])
+            self.db.executemany(
+                "INSERT INTO entries (key, size, created, last_hit) VALUES (?, ?, ?, ?)",
+                [(key, size, mtime, mtime) for key, (size, mtime) in on_disk.items()
+                 if key not in known]
+            )
+
+    def stats(self):
+        count, size, seconds = self.db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(compile_seconds), 0) FROM entries"
+        ).fetchone()
+        return {"entries": count, "bytes": size, "compile_seconds": seconds}
+
+    def prune(self, max_bytes=None, max_age=None):
+        self.sync()
+        rows = self.db.execute("SELECT key, size, last_hit FROM entries ORDER BY last_hit").fetchall()
+        total = sum(size for _, size, _ in rows)
+        cutoff = time.time() - max_age if max_age is not None else None
+        evicted, freed = [], 0
+        for key, size, last_hit in rows:
+            too_old = cutoff is not None and last_hit < cutoff
+            too_big = max_bytes is not None and total - freed > max_bytes
+            if not (too_old or too_big):
+                continue
+            path = os.path.join(self.store, key)
+            if os.path.exists(path + ".lock"):
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            evicted.append((key,))
+            freed += size
+        with self.db:
+            self.db.executemany("DELETE FROM entries WHERE key = ?", evicted)
+        return len(evicted), freed
+
+
+def _update_index(options, hits, created):
+    if sqlite3 is None:
+        return
+    try:
+        index = CacheIndex(options.cache_dir)
+        try:
+            index.record(hits, created)
+            if options.cache_max_size is not None or options.cache_max_age is not None:
+                index.prune(options.cache_max_size, options.cache_max_age)
+        finally:
+            index.close()
+    except (sqlite3.Error, OSError) as e:
+        sys.stderr.write(f"[tikz2svg] cache index not updated: {e}\n")
+
+
+# -----------------------------------------------------------------------------
+# Compile pipeline
+# - _plan_job: turn a job into pages, i.e. (code, style, store_svg) triples
+#   that need a TeX run, an optional post step run once the pages exist, and
+#   the media files to publish as (media_svg, candidate store entries, pages
+#   whose failure record explains a missing output). The post step returns
+#   pages that still have to be compiled. Pages with a failure record are
+#   not planned.
+#     * default: the black/white SVGs missing from the store
+#     * recolor: only the black SVG; the post step derives the white one from
+#       it, or asks for a real STYLE_WHITE page when the picture has explicit
+#       colours or its SVG cannot be mapped
+#     * output "adaptive": the black SVG, rewritten to currentColor by the
+#       post step; the black/white pair is not published
+# - _compile_pages: compile groups of pages (one group per job) with the
+#   configured engine on a bounded thread pool. The heavy lifting happens in
+#   lualatex/pdftocairo subprocesses, so threads keep all cores busy.
+#     * "run": one lualatex run per page
+#     * "pages": the pages of a group share one lualatex run
+#     * "daemon": pages are fed to persistent TeX workers
+#     * "batch": all pages in one document, split into `jobs` contiguous
+#       chunks so each worker compiles one document
+# - _compile_shared: compile pages under cross-process claims; pages claimed
+#   by another process sharing the cache are waited for instead, and only
+#   compiled here if that process neither published them nor recorded their
+#   failure. Failures are recorded before the claims are released.
+# - compile_jobs: plan, compile, post-process, compile the remaining pages,
+#   then publish the media files from the store (or a placeholder for failed
+#   pictures), record every picture for the build report and update the
+#   cache index.
+# -----------------------------------------------------------------------------
+def _run_tasks(tasks, workers):
+    if workers <= 1 or len(tasks) <= 1:
+        return [task() for task in tasks]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(lambda task: task(), tasks))
+
+
+def _plan_job(job, options):
+    black_key = cache_key(job.code, STYLE_BLACK)
+    black = store_path(black_key, options.cache_dir)
+    black_page = [(job.code, STYLE_BLACK, black)] if needs_compile(black, options) else []
+
+    if options.output == "adaptive":
+        adaptive = store_path(derived_key(black_key, CURRENT_COLOR), options.cache_dir)
+        publish = [(job.adaptive_svg, [adaptive], [black])]
+        if os.path.exists(adaptive):
+            return [], None, publish
+
+        def make_adaptive():
+            if os.path.exists(black):
+                recolor_svg_file(black, adaptive, CURRENT_COLOR, strict=False)
+            return []
+
+        return black_page, make_adaptive, publish
+
+    white = store_path(cache_key(job.code, STYLE_WHITE), options.cache_dir)
+    white_page = [(job.code, STYLE_WHITE, white)] if needs_compile(white, options) else []
+    if not options.recolor or has_explicit_colors(job.code):
+        return (black_page + white_page, None,
+                [(job.black_svg, [black], [black]), (job.white_svg, [white], [white])])
+
+    recolored = store_path(derived_key(black_key, WHITE), options.cache_dir)
+    publish = [(job.black_svg, [black], [black]), (job.white_svg, [recolored, white], [white, black])]
+    if os.path.exists(recolored) or os.path.exists(white):
+        return black_page, None, publish
+
+    def make_white():
+        if not os.path.exists(black):
+            return []  # black compile failed, already reported
+        if recolor_svg_file(black, recolored, WHITE):
+            return []
+        return white_page
+
+    return black_page, make_white, publish
+
+
+def _timed(task, out_svgs, slots=1, queued=None):
+    start = time.monotonic()
+    if queued is not None:
+        record_span("queue", queued, out_svgs)
+    task()
+    share = (time.monotonic() - start) * min(slots, len(out_svgs)) / len(out_svgs)
+    return {out_svg: share for out_svg in out_svgs}
+
+
+def _compile_pages(groups, options):
+    tasks = []
+    if options.engine == "daemon":
+        pages = [page for group in groups for page in group]
+        if pages:
+            tasks.append((functools.partial(compile_pages_daemon, pages, options),
+                          [page[2] for page in pages]))
+        workers = 1
+
+    elif options.engine == "batch":
+        pages = [page for group in groups for page in group]
+        size = max(1, -(-len(pages) // options.jobs))
+        tasks.extend((functools.partial(compile_pages_batch, pages[i:i + size], formats_dir(options),
+                                        options.scratch_dir),
+                      [page[2] for page in pages[i:i + size]])
+                     for i in range(0, len(pages), size))
+        workers = options.jobs
+
+    else:
+        for group in groups:
+            if options.engine == "pages" and len(group) > 1:
+                tasks.append((functools.partial(compile_tikz_pages, group, formats_dir(options),
+                                                scratch=options.scratch_dir),
+                              [out_svg for _, _, out_svg in group]))
+            else:
+                tasks.extend((functools.partial(compile_tikz_to_svg, code, out_svg, style,
+                                                formats_dir(options), options.scratch_dir), [out_svg])
+                             for code, style, out_svg in group)
+        workers = options.jobs
+
+    slots = options.jobs if options.engine == "daemon" else 1
+    queued = None if options.engine == "daemon" else time.monotonic()  # daemon pages queue per page
+    durations = {}
+    for timing in _run_tasks([functools.partial(_timed, task, outs, slots, queued)
+                              for task, outs in tasks], workers):
+        durations.update(timing)
+    return durations
+
+
+def _claim_pages(groups):
+    claimed, waiting = [], []
+    for group in groups:
+        mine = []
+        for page in group:
+            if os.path.exists(page[2]):
+                continue  # published meanwhile by another process
+            try:
+                claimed_page = claim_entry(page[2])
+            except OSError as e:  # e.g. a read-only cache directory
+                report_error([page[2]], f"cannot claim {page[2]}: {e}", record=False)
+                continue
+            (mine if claimed_page else waiting).append(page)
+        if mine:
+            claimed.append(mine)
+    return claimed, waiting
+
+
+def _compile_shared(groups, options):
+    durations = {}
+    for attempt in range(2):
+        claimed, waiting = _claim_pages(groups)
+        try:
+            durations.update(_compile_pages(claimed, options))
+            record_failures((page for group in claimed for page in group), options)
+        finally:
+            for page in (page for group in claimed for page in group):
+                release_entry(page[2])
+        for page in waiting:
+            wait_for_entry(page[2])
+        groups = [[page] for page in waiting
+                  if not os.path.exists(page[2]) and not os.path.exists(failure_path(page[2], options))]
+        if not groups:
+            return durations
+    durations.update(_compile_pages(groups, options))
+    record_failures((page for group in groups for page in group), options)
+    return durations
+
+
+def compile_jobs(jobs, options=None):
+    options = options or FilterOptions()
+    os.makedirs(store_dir(options.cache_dir), exist_ok=True)
+    groups, posts, publish, pictures = [], [], [], []
+    planned = set()  # identical pictures share their store entries
+    for job in jobs:
+        pages, post, outputs = _plan_job(job, options)
+        pages = [page for page in pages if page[2] not in planned]
+        planned.update(page[2] for page in pages)
+        if pages:
+            groups.append(pages)
+        if post is not None:
+            posts.append(post)
+        publish.extend(outputs)
+        pictures.append((job, outputs))
+
+    existing = {svg for _, candidates, _ in publish for svg in candidates if os.path.exists(svg)}
+    durations = _compile_shared(groups, options)
+    missing = {svg for _, candidates, _ in publish for svg in candidates if not os.path.exists(svg)}
+    remaining = [post() for post in posts]
+    derived = {svg for svg in missing if os.path.exists(svg)}  # written by the post steps
+    durations.update(_compile_shared([pages for pages in remaining if pages], options))
+    # entries produced here; the rest came from the store or from another
+    # process whose claim this run waited for
+    compiled = durations.keys() | derived
+
+    used, failed, written = set(), set(), set()  # written: outputs this run wrote or linked
+    for out_svg, candidates, sources in publish:
+        try:
+            for store_svg in candidates:
+                if os.path.exists(store_svg):
+                    with timed_stage("publish", [store_svg]):
+                        if publish_svg(store_svg, out_svg):
+                            written.add(out_svg)
+                    used.add(store_svg)
+                    break
+            else:
+                if publish_placeholder(out_svg, sources, options):
+                    written.add(out_svg)
+                failed.add(out_svg)
+        except OSError as e:  # e.g. a read-only media directory
+            report_error([out_svg], f"cannot publish {out_svg}: {e}", record=False)
+            failed.add(out_svg)
+
+    for job, outputs in pictures:
+        keys = {svg for _, candidates, sources in outputs for svg in candidates + sources}
+        if any(out_svg in failed for out_svg, _, _ in outputs):
+            status = "failed"
+        elif keys & compiled:
+            status = "miss"
+        elif all(existing.intersection(candidates) for _, candidates, _ in outputs):
+            status = "hit"
+        else:
+            status = "waited"
+        record_picture(job, status, keys,
+                       sum(os.path.getsize(out_svg) for out_svg, _, _ in outputs if out_svg in written))
+
+    created = {svg: durations.get(svg, 0.0) for svg in compiled if os.path.exists(svg)}
+    _update_index(options, used - created.keys(), created)
+
+
+# -----------------------------------------------------------------------------
+# Media garbage collection
+# - Numbered media names change whenever sections or figures move, leaving the
+#   old files behind. Each run writes a manifest of the media files it
+#   referenced to <cache-dir>/manifests/<media dir hash>/<document>.txt.
+# - unreferenced_media: media files with the filter's naming scheme that no
+#   manifest of that media directory mentions.
+# - collect_garbage: report or delete them; used at the end of a run (gc
+#   option) and by the `gc` subcommand. Delete a document's manifest to stop
+#   keeping its files alive.
+# -----------------------------------------------------------------------------
+MEDIA_NAME_RE = re.compile(r"^[0-9_]+_[0-9a-f]{40}(?:_black|_white)?\.svg$")
+
+
+def manifest_dir(cache_dir: str, media_dir: str = MEDIA_PATH) -> str:
+    return os.path.join(cache_dir, "manifests", sha1_hash(os.path.abspath(media_dir))[:12])
 
+
+def write_manifest(cache_dir: str, document: str, files, media_dir: str = MEDIA_PATH):
+    directory = manifest_dir(cache_dir, media_dir)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, document + ".txt")
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.writelines(name + "\n" for name in sorted({os.path.basename(p) for p in files}))
+    os.replace(tmp, path)
+
+
+def unreferenced_media(cache_dir: str, media_dir: str = MEDIA_PATH):
+    referenced = set()
+    directory = manifest_dir(cache_dir, media_dir)
+    if os.path.isdir(directory):
+        for entry in os.scandir(directory):
+            if entry.name.endswith(".txt"):
+                with open(entry.path, encoding="utf-8") as f:
+                    referenced.update(line.strip() for line in f)
+    if not os.path.isdir(media_dir):
+        return []
+    return sorted(entry.path for entry in os.scandir(media_dir)
+                  if MEDIA_NAME_RE.match(entry.name) and entry.name not in referenced)
+
+
+def collect_garbage(cache_dir: str, delete: bool, media_dir: str = MEDIA_PATH):
+    orphans = unreferenced_media(cache_dir, media_dir)
+    freed = 0
+    for path in orphans:
+        freed += os.path.getsize(path)
+        if delete:
+            os.remove(path)
+    return orphans, freed
+
+
+# -----------------------------------------------------------------------------
+# MyST emission
+# - _adaptive_svg: the adaptive SVG prepared for inlining (inline_svg), or
+#   None if it is missing; shared by the block and the inline emission.
+# - _image_lines: the image part of a picture; for "pair" the dark/light divs,
+#   for "adaptive" the currentColor SVG inlined as raw HTML so it inherits the
+#   page's text colour (an <img> would not). Falls back to an image reference
+#   if the SVG is missing.
+# - _figure_myst: FOUR-colon figure directive holding the image part. A figure
+#   with several pictures becomes a FIVE-colon figure holding one FOUR-colon
+#   subfigure per picture (with its own caption and label, if the LaTeX
+#   source gave one), which MyST lays out side by side like the subfigures.
+# - _center_myst: the image part of each picture emitted as siblings so that
+#   it is not wrapped in a centering container; one block per picture
+# - _raw_myst: a bare raw block/inline with each picture replaced in place and
+#   the LaTeX around it kept as raw pieces. Blocks get the image part, inline
+#   pictures an HTML <img> pair with the same theme classes (or the inlined
+#   currentColor SVG), which stays inside the paragraph.
+# -----------------------------------------------------------------------------
+def _adaptive_svg(job):
+    # the inlined SVG, or None if it is missing
+    try:
+        with open(job.adaptive_svg, encoding="utf-8") as f:
+            return inline_svg(f.read(), f"t{sha1_hash(job.adaptive_svg)[:8]}-")
+    except OSError:
+        return None
+
+
+def _image_lines(job, options):
+    if options.output == "adaptive":
+        svg = _adaptive_svg(job)
+        if svg is None:
+            adaptive_rel = job.adaptive_svg.replace("\\", "/")
+            return [f"![]({adaptive_rel})"]
+        return ['<div class="tikz-adaptive">', svg, "</div>"]
+
+    # Use forward slashes in generated links (cross-platform)
+    black_rel = job.black_svg.replace("\\", "/")
+    white_rel = job.white_svg.replace("\\", "/")
+
+    lines = []
+    # dark image
+    lines.append(":::{div}")
+    lines.append(":class: dark:hidden")
+    lines.append(f"![]({black_rel})")
+    lines.append(":::")
+    lines.append("")  # blank line between divs
+    # light image
+    lines.append(":::{div}")
+    lines.append(":class: hidden dark:block")
+    lines.append(f"![]({white_rel})")
+    lines.append(":::")
+    return lines
+
+
+def _inline_html(job, options):
+    if options.output == "adaptive":
+        svg = _adaptive_svg(job)
+        if svg is None:
+            adaptive_rel = job.adaptive_svg.replace("\\", "/")
+            return f"![]({adaptive_rel})"
+        return '<span class="tikz-adaptive">' + " ".join(svg.split("\n")) + "</span>"
+
+    black_rel = job.black_svg.replace("\\", "/")
+    white_rel = job.white_svg.replace("\\", "/")
+    return (f'<img src="{black_rel}" alt="" class="dark:hidden"/>'
+            f'<img src="{white_rel}" alt="" class="hidden dark:inline"/>')
+
+
+def _raw_myst(elem, jobs, options):
+    pieces, pos = [], 0
+    for (start, end, _), job in zip(scan_tikz(elem.text), jobs):
+        if elem.text[pos:start].strip():
+            pieces.append(type(elem)(elem.text[pos:start], format=elem.format))
+        if isinstance(elem, pf.RawInline):
+            pieces.append(pf.RawInline(_inline_html(job, options), format="markdown"))
+        else:
+            md = "\n".join(_image_lines(job, options)).strip() + "\n"
+            pieces.append(pf.RawBlock(md, format="markdown"))
+        pos = end
+    if elem.text[pos:].strip():
+        pieces.append(type(elem)(elem.text[pos:], format=elem.format))
+    return pieces
+
+
+def _figure_myst(elem, jobs, options):
+    label = elem.identifier or ""
+    # use pf.stringify for caption (keeps existing behavior)
+    caption = pf.stringify(elem.caption) if elem.caption else ""
+
+    # Build the MyST block using explicit literal strings to avoid accidental brace/newline insertion.
+    # Use :label: field (if present).
+    label_field = f":label: {label}\n" if label else ""
+    fence = "::::" if len(jobs) == 1 else ":::::"  # subfigures nest one level deeper
+
+    myst_lines = []
+    myst_lines.append(fence + "{figure}")          # FOUR (FIVE) colons outer fence
+    if label_field:
+        myst_lines.append(label_field.rstrip())
+    myst_lines.append(f":alt: {caption}")
+    myst_lines.append("")  # blank line
+    if len(jobs) == 1:
+        myst_lines.extend(_image_lines(jobs[0], options))
+    else:
+        for i, job in enumerate(jobs):
+            if i:
+                myst_lines.append("")
+            myst_lines.append("::::{figure}")
+            if job.label:
+                myst_lines.append(f":label: {job.label}")
+            myst_lines.append(f":alt: {job.caption or caption}")
+            myst_lines.append("")
+            myst_lines.extend(_image_lines(job, options))
+            if job.caption:
+                myst_lines.append("")
+                myst_lines.append(job.caption)
+            myst_lines.append("::::")
+    myst_lines.append("")  # blank line before caption
+    myst_lines.append(caption)
+    myst_lines.append(fence)  # close outer figure
+
+    myst = "\n".join(myst_lines) + "\n"
+
+    # Return as markdown raw block so Pandoc doesn't escape newlines as entities
+    return [pf.RawBlock(myst, format="markdown")]
+
+
+def _center_myst(jobs, options):
+    blocks = []
+    for job in jobs:
+        md_lines = _image_lines(job, options)
+        md_lines.append("")
+
+        md = "\n".join(md_lines).strip() + "\n"
+        blocks.append(pf.RawBlock(md, format="markdown"))
+    return blocks
+
+
+# -----------------------------------------------------------------------------
+# Main filter action
+# - tikz_filter: invoked for each AST element. Responsibilities:
+#     * track Header elements to build numbering state for filenames
+#     * replace pf.Figure nodes containing Raw LaTeX TikZ blocks with a MyST
+#       FOUR-colon figure directive
+#     * replace pf.Div with class "center" containing TikZ with two MyST
+#       ::: {div} blocks (or one inline SVG for the "adaptive" output) per
+#       picture
+#     * replace the pictures in other LaTeX RawBlocks and RawInlines in place
+#     * leave other elements unchanged
+# - Jobs collected by prepare() have already been compiled in parallel; an
+#   element without a collected job (tikz_filter used on its own) is numbered
+#   and compiled on the spot, as before.
+# - The function tries to be defensive: if extraction fails, it returns the
+#   original element to avoid breaking the AST.
+# -----------------------------------------------------------------------------
+def tikz_filter(elem, doc):
+
+    # --- 1) Track header numbering for image filenames ---
+    if isinstance(elem, pf.Header):
+        _track_header(elem, doc)
         return elem
 
+    # --- 2) Handle Figure nodes (LaTeX \begin{figure}), Div.center and raw LaTeX ---
+    if isinstance(elem, (pf.Figure, pf.Div, pf.RawBlock, pf.RawInline)):
+        options = getattr(doc, "tikz_options", None) or read_options(doc)
+        jobs = getattr(doc, "tikz_jobs", {}).get(id(elem))
+        if jobs is None:
+            jobs = _make_jobs(elem, doc)
+            if not jobs:
+                return elem
+            compile_jobs(jobs, options)
+
+        if not hasattr(doc, "tikz_referenced"):
+            doc.tikz_referenced = set()
+        for job in jobs:
+            doc.tikz_referenced.update(_job_outputs(job, options))
+
+        if isinstance(elem, pf.Figure):
+            return _figure_myst(elem, jobs, options)
+        if isinstance(elem, pf.Div):
+            return _center_myst(jobs, options)
+        return _raw_myst(elem, jobs, options)
+
     # --- default: no change ---
     return elem
 
 
+# -----------------------------------------------------------------------------
+# Watch mode
+# - `tikz2svg.py watch INPUT... -o OUTPUT` keeps running, polls the inputs and
+#   on every save converts them with pandoc, runs the filter on the AST and
+#   writes OUTPUT, like `pandoc INPUT --filter tikz2svg.py -o OUTPUT`.
+# - WatchState: what the previous rebuild saw: a digest per section (chapter
+#   and section title) and the media paths of every picture it produced.
+# - _collect_sections: the collect walk of prepare(), done block by block so
+#   every job is attributed to its section while the sections are digested.
+# - rebuild: pictures whose media paths the previous rebuild already produced
+#   (and which still exist) are not looked at again (no store lookups). New
+#   or changed pictures in the edited sections (those whose digest changed)
+#   are compiled first, then the output is written, then the remaining new
+#   pictures are compiled, nearest sections first, and the output is written
+#   again with them.
+# -----------------------------------------------------------------------------
+@dataclass
+class WatchState:
+    options: FilterOptions = None
+    sections: dict = None
+    published: set = None
+
+
+def _collect_sections(doc):
+    digests, owners = {}, {}
+    chapter = section = ""
+    for block in doc.content:
+        if isinstance(block, pf.Header) and block.level <= 2:
+            if block.level == 1:
+                chapter, section = pf.stringify(block), ""
+            else:
+                section = pf.stringify(block)
+        current = (chapter, section)
+        digests.setdefault(current, hashlib.sha1()).update(json.dumps(block.to_json()).encode("utf-8"))
+        known = set(doc.tikz_jobs)
+        block.walk(collect_tikz, doc)
+        owners.update((key, current) for key in doc.tikz_jobs.keys() - known)
+    return {key: digest.hexdigest() for key, digest in digests.items()}, owners
+
+
+def _load_sections(ast: bytes):
+    doc = pf.load(io.StringIO(ast.decode("utf-8")))
+    doc.tikz_options = read_options(doc)
+    doc.tikz_jobs = {}
+    _reset_numbering(doc)
+    sections, owners = _collect_sections(doc)
+    return doc, sections, owners
+
+
+def _write_watched(args, doc):
+    _reset_numbering(doc)
+    doc.tikz_referenced = set()
+    with timed_stage("walk"):
+        doc = doc.walk(tikz_filter, doc)
+    with io.StringIO() as out:
+        pf.dump(doc, out)
+        filtered = out.getvalue().encode("utf-8")
+    writer = [args.pandoc, "--from", "json", "--output", args.output] + (["--to", args.write] if args.write else [])
+    subprocess.run(writer + args.pandoc_arg, input=filtered, check=True)
+    return doc
+
+
+def rebuild(args, state):
+    start = time.monotonic()
+    reset_report()
+    reader = [args.pandoc] + (["--from", args.read] if args.read else [])
+    ast = subprocess.run(reader + args.inputs + ["--to", "json"] + args.pandoc_arg,
+                         check=True, stdout=subprocess.PIPE).stdout
+    doc, sections, owners = _load_sections(ast)
+
+    options = doc.tikz_options
+    if options != state.options:
+        state.options, state.sections, state.published = options, {}, set()
+
+    position = {key: i for i, key in enumerate(sections)}
+    edited = {position[key] for key, digest in sections.items() if state.sections.get(key) != digest}
+    # a published picture whose media files were deleted meanwhile is new again
+    new = [(key, job) for key, jobs in doc.tikz_jobs.items() for job in jobs
+           if _job_outputs(job, options) not in state.published
+           or not all(os.path.exists(path) for path in _job_outputs(job, options))]
+    new.sort(key=lambda item: min((abs(position[owners[item[0]]] - i) for i in edited), default=0))
+    first = [job for key, job in new if position[owners[key]] in edited]
+    rest = [job for key, job in new if position[owners[key]] not in edited]
+
+    compile_jobs(first, options)
+    written = _write_watched(args, doc)
+    sys.stderr.write(f"[tikz2svg] {args.output} written in {time.monotonic() - start:.2f} s "
+                     f"({len(first)} pictures compiled, {len(rest)} more queued)\n")
+
+    if rest:
+        # their images were written as plain links to files that did not
+        # exist yet (inlined outputs cannot be), so write the output again
+        compile_jobs(rest, options)
+        written = _write_watched(args, _load_sections(ast)[0])
+        sys.stderr.write(f"[tikz2svg] {args.output} written again with {len(rest)} more pictures "
+                         f"after {time.monotonic() - start:.2f} s\n")
+    finalize(written)
+    state.sections = sections
+    state.published = {_job_outputs(job, options) for jobs in doc.tikz_jobs.values() for job in jobs
+                       if all(os.path.exists(path) for path in _job_outputs(job, options))}
+
+
+def watch_command(argv):
+    parser = argparse.ArgumentParser(prog="tikz2svg.py watch",
+                                     description="Rebuild OUTPUT whenever an input changes, "
+                                                 "compiling only new or changed pictures.")
+    parser.add_argument("inputs", nargs="+")
+    parser.add_argument("-o", "--output", required=True)
+    parser.add_argument("-f", "--from", dest="read", help="pandoc input format")
+    parser.add_argument("-t", "--to", dest="write", help="pandoc output format")
+    parser.add_argument("--pandoc", default="pandoc", help="pandoc executable")
+    parser.add_argument("--pandoc-arg", action="append", default=[],
+                        help="extra pandoc argument (repeatable), e.g. --pandoc-arg=-Mtikz2svg-jobs=8")
+    parser.add_argument("--interval", type=float, default=0.2, help="polling interval in seconds")
+    args = parser.parse_args(argv)
+
+    state = WatchState()
+    seen = None
+    try:
+        while True:
+            try:
+                mtimes = [os.stat(path).st_mtime_ns for path in args.inputs]
+            except FileNotFoundError:
+                mtimes = seen  # editors may replace the file on save
+            if mtimes != seen:
+                seen = mtimes
+                try:
+                    rebuild(args, state)
+                except (subprocess.CalledProcessError, OSError) as e:
+                    sys.stderr.write(f"[tikz2svg] rebuild failed: {e}\n")
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        return 0
+
+
+# -----------------------------------------------------------------------------
+# JSON input/output
+# - JSON_BACKEND: orjson if installed, else ujson, else the json module. Both
+#   produce the compact UTF-8 JSON pandoc writes itself.
+# - json_loads / json_dumps: parse str or bytes / serialize to UTF-8 bytes;
+#   panflute elements are serialized through their to_json on the way.
+# - load_doc: pf.load on a string already read; the panflute walk keeps
+#   json's object_hook, which builds the objects during parsing and is faster
+#   than converting a tree parsed by another backend.
+# - write_json: serialize straight to the binary stdout buffer (pf.dump
+#   builds the whole document as str and encodes it again through a text
+#   wrapper, holding both copies).
+# -----------------------------------------------------------------------------
+JSON_BACKEND = "orjson" if orjson is not None else "ujson" if ujson is not None else "json"
+
+
+def json_loads(data):
+    if JSON_BACKEND == "orjson":
+        return orjson.loads(data)
+    if JSON_BACKEND == "ujson":
+        return ujson.loads(data)
+    return json.loads(data)
+
+
+def _element_json(elem):
+    return elem.to_json()
+
+
+def json_dumps(obj) -> bytes:
+    if JSON_BACKEND == "orjson":
+        return orjson.dumps(obj, default=_element_json)
+    if JSON_BACKEND == "ujson":
+        return ujson.dumps(obj, default=_element_json, ensure_ascii=False,
+                           escape_forward_slashes=False).encode("utf-8")
+    return json.dumps(obj, default=_element_json, check_circular=False,
+                      separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def load_doc(text: str):
+    doc = json.loads(text, object_hook=pf.elements.from_json)
+    doc.format = sys.argv[1] if len(sys.argv) > 1 else "html"
+    return doc
+
+
+def write_json(obj):
+    sys.stdout.buffer.write(json_dumps(obj))
+    sys.stdout.buffer.flush()
+
+
+# -----------------------------------------------------------------------------
+# JSON fast path ("json" ast)
+# - pf.run_filter turns every Str and Space of the document into a panflute
+#   object and back. The filter only looks at headers, figures, centered divs
+#   and raw LaTeX with pictures, so json_filter keeps the AST as parsed JSON
+#   and materializes just those nodes; all other nodes are written back as
+#   they came in.
+# - metadata_doc: a panflute Doc holding only the metadata, for the options
+#   and as the `doc` handed to the filter functions. The metadata is decoded
+#   on its own, so the choice of walk costs nothing on the panflute path.
+# - _walk_json: post-order walk over the JSON in panflute's order (metadata,
+#   then blocks). `visit(node, parent)` may return a list of nodes replacing
+#   the node; parent is the enclosing element node.
+# - _json_in_container: JSON counterpart of _is_container(elem.parent) for a
+#   raw node, which is materialized without its parent.
+# - json_filter: the same two walks as prepare() and tikz_filter on the
+#   materialized nodes, so the output is identical to the panflute walk.
+#   Figures and centered divs are materialized again before substituting,
+#   as pictures nested in them (e.g. in a caption) were replaced meanwhile.
+# -----------------------------------------------------------------------------
+_JSON_KEY_RE = {key: re.compile(rf'"{key}"\s*:\s*') for key in ("pandoc-api-version", "meta")}
+_JSON_LEAVES = frozenset(("Str", "Space", "SoftBreak", "LineBreak", "Math", "Code",
+                          "CodeBlock", "HorizontalRule"))
+
+
+def metadata_doc(text: str):
+    # both keys are unique: inside the blocks they could only appear escaped
+    decoder = json.JSONDecoder()
+    top = {}
+    for key, pattern in _JSON_KEY_RE.items():
+        match = pattern.search(text)
+        if match is None:
+            return None
+        top[key] = decoder.raw_decode(text, match.end())[0]
+    return pf.load(io.StringIO(json.dumps(dict(top, blocks=[]))))
+
+
+def _materialize(node):
+    return json.loads(json.dumps(node), object_hook=pf.elements.from_json)
+
+
+def _json_in_container(node, parent):
+    if parent is None:
+        return False
+    if parent["t"] == "Figure":
+        children = parent["c"][2]
+    elif parent["t"] == "Div" and "center" in parent["c"][0][1]:
+        children = parent["c"][1]
+    else:
+        return False
+    return any(child is node for child in children)
+
+
+def _walk_json(node, visit, parent=None):
+    if isinstance(node, list):
+        replaced = []
+        for i, item in enumerate(node):
+            if isinstance(item, (dict, list)):
+                result = _walk_json(item, visit, parent)
+                if result is not None:
+                    replaced.append((i, result))
+        for i, result in reversed(replaced):
+            node[i:i + 1] = result
+        return None
+
+    tag = node.get("t")
+    if tag is None:  # metadata map
+        for value in node.values():
+            if isinstance(value, (dict, list)):
+                _walk_json(value, visit, parent)
+        return None
+    if tag in _JSON_LEAVES:
+        return None
+    if tag != "RawBlock" and tag != "RawInline" and isinstance(node.get("c"), (dict, list)):
+        _walk_json(node["c"], visit, node)
+    return visit(node, parent)
+
+
+def json_filter(text: str, doc):
+    data = json_loads(text)
+    nodes = {}  # id(node) -> (node, element), the node keeps its id alive
+
+    def collect(node, parent):
+        tag = node["t"]
+        if tag == "RawBlock" or tag == "RawInline":
+            fmt, raw = node["c"]
+            if fmt not in RAW_FORMATS or not _TIKZ_ENV_RE.search(raw) or _json_in_container(node, parent):
+                return
+        elif not (tag == "Header" or tag == "Figure" or (tag == "Div" and "center" in node["c"][0][1])):
+            return
+        elem = _materialize(node)
+        nodes[id(node)] = node, elem
+        collect_tikz(elem, doc)
+
+    def substitute(node, parent):
+        if id(node) not in nodes:
+            return None
+        elem = nodes[id(node)][1]
+        jobs = doc.tikz_jobs.pop(id(elem), None)
+        if node["t"] == "Figure" or node["t"] == "Div":
+            # pictures inside it (e.g. in the caption) are substituted by now
+            elem = _materialize(node)
+        # keyed only while elem is alive: a freed element's id is reused
+        if jobs is not None:
+            doc.tikz_jobs[id(elem)] = jobs
+        try:
+            result = tikz_filter(elem, doc)
+        finally:
+            doc.tikz_jobs.pop(id(elem), None)
+        if result is elem:
+            return None
+        return [elem.to_json() for elem in (result if isinstance(result, list) else [result])]
+
+    reset_report()
+    _reset_numbering(doc)
+    doc.tikz_jobs = {}
+    with timed_stage("walk"):
+        _walk_json(data["meta"], collect)
+        _walk_json(data["blocks"], collect)
+    doc.tikz_options = read_options(doc)
+    compile_jobs([job for jobs in doc.tikz_jobs.values() for job in jobs], doc.tikz_options)
+
+    _reset_numbering(doc)
+    doc.tikz_referenced = set()
+    with timed_stage("walk"):
+        _walk_json(data["meta"], substitute)
+        _walk_json(data["blocks"], substitute)
+    finalize(doc)
+
+    write_json(data)
+
+
 # -----------------------------------------------------------------------------
 # prepare and main
-# - prepare: initialize doc-scoped counters before processing
-# - main: run the panflute filter with tikz_filter action
+# - prepare: collect every TikZ job in a first walk, compile them all on a
+#   pool of `jobs` workers, then reset the counters so the substituting
+#   walk (tikz_filter) starts from the same numbering state.
+# - finalize: write the build report, trace and metrics (report / trace /
+#   metrics options) and this document's media manifest and, with the gc
+#   option, report or delete media files no document references any more.
+# - main: run the panflute filter with tikz_filter action (or json_filter for
+#   the "json" ast), or one of the maintenance subcommands (`tikz2svg.py
+#   cache stats|prune ...`, `tikz2svg.py gc [--delete]`, `tikz2svg.py watch
+#   ...`) when called with its name as first argument (pandoc passes the
+#   output format there). Scratch directories are removed on SIGTERM too.
 # -----------------------------------------------------------------------------
-def prepare(doc):
+def _reset_numbering(doc):
     doc.level1_number = []
     doc.level2_number = []
     doc.image_num_per_level2 = {}
+    doc.section_title = ""
+
+
+def prepare(doc):
+    reset_report()
+    _reset_numbering(doc)
+    doc.tikz_jobs = {}
+    with timed_stage("walk"):
+        doc.walk(collect_tikz, doc)
+    doc.tikz_options = read_options(doc)
+    compile_jobs([job for jobs in doc.tikz_jobs.values() for job in jobs], doc.tikz_options)
+    _reset_numbering(doc)
+    doc.tikz_referenced = set()
+    doc.tikz_walk_start = time.monotonic()  # the substituting walk runs until finalize
+
+
+def finalize(doc):
+    options = getattr(doc, "tikz_options", None) or read_options(doc)
+    if hasattr(doc, "tikz_walk_start"):
+        record_span("walk", doc.tikz_walk_start)
+    if options.report:
+        write_report(options)
+    if options.trace:
+        write_trace(options)
+    if options.metrics:
+        write_metrics(options)
+    referenced = getattr(doc, "tikz_referenced", set())
+    if not referenced and not os.path.isdir(MEDIA_PATH):
+        return
+    try:
+        write_manifest(options.cache_dir, options.document, referenced)
+        if options.gc == "off":
+            return
+        orphans, freed = collect_garbage(options.cache_dir, options.gc == "delete")
+    except OSError as e:
+        sys.stderr.write(f"[tikz2svg] media gc failed: {e}\n")
+        return
+    if orphans:
+        action = "deleted" if options.gc == "delete" else "found"
+        sys.stderr.write(f"[tikz2svg] {action} {len(orphans)} unreferenced media files "
+                         f"({freed / 1024:.0f} KiB)\n")
+        if options.gc == "report":
+            for path in orphans[:10]:
+                sys.stderr.write(f"  {path}\n")
+            if len(orphans) > 10:
+                sys.stderr.write(f"  ... and {len(orphans) - 10} more\n")
+
+
+def cache_command(argv):
+    parser = argparse.ArgumentParser(prog="tikz2svg.py cache", description="Inspect or prune the SVG cache.")
+    parser.add_argument("action", choices=("stats", "prune"))
+    parser.add_argument("--cache-dir", default=os.environ.get("TIKZ2SVG_CACHE_DIR", CACHE_PATH))
+    parser.add_argument("--max-size", help="evict least recently used entries above this size, e.g. 2G")
+    parser.add_argument("--max-age", help="evict entries not used for this long, e.g. 30d")
+    args = parser.parse_args(argv)
+    if sqlite3 is None:
+        sys.stderr.write("[tikz2svg] the cache index needs Python's sqlite3 module\n")
+        return 1
+
+    index = CacheIndex(os.path.expanduser(args.cache_dir))
+    try:
+        if args.action == "prune":
+            evicted, freed = index.prune(parse_size(args.max_size), parse_age(args.max_age))
+            print(f"evicted {evicted} entries, freed {freed / 1024 ** 2:.1f} MiB")
+        else:
+            index.sync()
+        stats = index.stats()
+        print(f"{stats['entries']} entries, {stats['bytes'] / 1024 ** 2:.1f} MiB, "
+              f"{stats['compile_seconds']:.0f} s of compile time")
+    finally:
+        index.close()
+    return 0
+
+
+def gc_command(argv):
+    parser = argparse.ArgumentParser(prog="tikz2svg.py gc",
+                                     description="List (or delete) media SVGs no document references.")
+    parser.add_argument("--delete", action="store_true", help="delete the files instead of listing them")
+    parser.add_argument("--media-dir", default=MEDIA_PATH)
+    parser.add_argument("--cache-dir", default=os.environ.get("TIKZ2SVG_CACHE_DIR", CACHE_PATH))
+    args = parser.parse_args(argv)
+
+    orphans, freed = collect_garbage(os.path.expanduser(args.cache_dir), args.delete, args.media_dir)
+    for path in orphans:
+        print(path)
+    action = "deleted" if args.delete else "unreferenced"
+    sys.stderr.write(f"{len(orphans)} files {action} ({freed / 1024:.0f} KiB)\n")
+    return 0
+
+
+COMMANDS = {"cache": cache_command, "gc": gc_command, "watch": watch_command}
 
 
 def main(doc=None):
-    pf.run_filter(tikz_filter, prepare=prepare, doc=doc)
+    signal.signal(signal.SIGTERM, _terminate)
+    if doc is None and len(sys.argv) > 1 and sys.argv[1] in COMMANDS:
+        sys.exit(COMMANDS[sys.argv[1]](sys.argv[2:]))
+    if doc is None:
+        text = sys.stdin.buffer.read().decode("utf-8")
+        meta = metadata_doc(text)
+        if meta is not None and get_ast(meta) == "json":
+            json_filter(text, meta)
+            return
+        doc = load_doc(text)
+        del text
+        doc = pf.run_filter(tikz_filter, prepare=prepare, finalize=finalize, doc=doc)
+        write_json(doc)
+        return
+    pf.run_filter(tikz_filter, prepare=prepare, finalize=finalize, doc=doc)
 
 
 if __name__ == "__main__":